@@ -0,0 +1,134 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Runs a Whitespace program against many input cases in parallel.
+#
+# The program is decoded once, and each worker process of the pool keeps
+# its own loaded WhitespaceVM, so the cases don't pay any startup or
+# parsing cost. The expected output of case.in is read from case.out.
+
+import concurrent.futures
+import io
+import json
+import optparse
+import os
+import sys
+import time
+
+import interpreter
+
+# The VM of the worker process
+worker_vm = None
+
+# Prepares a worker process: loads the decoded program in its VM
+def init_worker(decoded, compile):
+	global worker_vm
+	worker_vm = interpreter.WhitespaceVM(stdout=io.StringIO(), compile=compile, interactive=False)
+	worker_vm.load_decoded(*decoded)
+
+# Compares two outputs, ignoring the whitespace at the end of the lines
+# and of the text
+def same_output(output, expected):
+	def lines(text):
+		return [line.rstrip() for line in text.rstrip().splitlines()]
+	return lines(output) == lines(expected)
+
+# Runs a case in the worker VM. Returns the result of the case.
+def run_case(case):
+	name, input_path, expected = case
+	vm = worker_vm
+	result = {'case': name}
+	f = open(input_path)
+	try:
+		vm.stdin = f
+		vm.stdout = io.StringIO()
+		vm.reset()
+		start = time.perf_counter()
+		try:
+			vm.run()
+			result['error'] = None
+		except Exception as e:
+			result['error'] = '%s: %s' % (type(e).__name__, e)
+		result['time'] = time.perf_counter() - start
+	finally:
+		f.close()
+	#
+	result['output'] = vm.stdout.getvalue()
+	if result['error'] is not None:
+		result['status'] = 'error'
+	elif expected is None:
+		result['status'] = 'done'
+	elif same_output(result['output'], expected):
+		result['status'] = 'pass'
+	else:
+		result['status'] = 'fail'
+	return result
+
+# Returns the (name, input path, expected output or None) of the cases
+def find_cases(input_paths):
+	cases = []
+	for input_path in input_paths:
+		name = os.path.splitext(input_path)[0]
+		expected = None
+		if os.path.exists(name + '.out'):
+			f = open(name + '.out')
+			expected = f.read(-1)
+			f.close()
+		cases.append((name, input_path, expected))
+	return cases
+
+# Runs the program of filename against the input files, using jobs
+# processes (all the cores by default). Returns the list of results.
+def run_cases(filename, input_paths, jobs=None, compile=False, cache=False):
+	vm = interpreter.WhitespaceVM()
+	vm.load_file(filename, cache=cache)
+	decoded = (vm.code, vm.program, vm.labels)
+	#
+	cases = find_cases(input_paths)
+	jobs = jobs or os.cpu_count() or 1
+	chunksize = max(1, len(cases) // (4 * jobs))
+	with concurrent.futures.ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(decoded, compile)) as pool:
+		return list(pool.map(run_case, cases, chunksize=chunksize))
+
+# Prints the results, one line per case and a summary
+def print_report(results, wall_time, out=sys.stdout):
+	for result in results:
+		line = "%-6s %8.3fs  %s" % (result['status'].upper(), result['time'], result['case'])
+		if result['error'] is not None:
+			line += "  (%s)" % result['error']
+		out.write(line + "\n")
+	#
+	counts = {}
+	for result in results:
+		counts[result['status']] = counts.get(result['status'], 0) + 1
+	summary = ", ".join("%d %s" % (counts[status], status) for status in sorted(counts))
+	cpu_time = sum(result['time'] for result in results)
+	out.write("%d cases: %s. Run time %.3fs, wall time %.3fs\n" % (len(results), summary, cpu_time, wall_time))
+
+def main():
+	parser = optparse.OptionParser(usage="%prog [options] program.ws case.in [case.in ...]")
+	parser.add_option("-j", "--jobs",  type="int", default=None, help="Number of worker processes (default: number of cores)")
+	parser.add_option("-c", "--compile",  action="store_true", default=False, help="Compile the program to Python before running it")
+	parser.add_option("--cache",  action="store_true", default=False, help="Keep the decoded program in a .wsc file next to the source")
+	parser.add_option("--json",  default=None, help="Write the results, including the outputs, to this JSON file")
+
+	(opts, args) = parser.parse_args()
+	if len(args) < 2:
+		parser.print_help()
+		sys.exit(-1)
+
+	start = time.perf_counter()
+	results = run_cases(args[0], args[1:], jobs=opts.jobs, compile=opts.compile, cache=opts.cache)
+	wall_time = time.perf_counter() - start
+	print_report(results, wall_time)
+	#
+	if opts.json is not None:
+		f = open(opts.json, 'w')
+		json.dump({'program': args[0], 'wall_time': wall_time, 'results': results}, f, indent=1)
+		f.close()
+	#
+	if any(result['status'] in ('fail', 'error') for result in results):
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
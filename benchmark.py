@@ -0,0 +1,209 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Benchmarks of the interpreter and of the WhiteSpace code generator.
+#
+# Each benchmark builds a representative program with the generator and
+# runs it with both execution engines. The results (instructions per
+# second, wall time, peak memory, code size and generation time) are
+# printed and can be saved as JSON, and compared with a previous run
+# (the speedup shown is the ratio of instructions per second):
+#
+#     python3 benchmark.py --output before.json
+#     python3 benchmark.py --compare before.json
+
+import io
+import json
+import optparse
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import interpreter
+import whitespac3
+
+# Counting loop: decrements a heap cell until it's zero
+def build_loop(size):
+	s = whitespac3.WhiteSpace()
+	s.store(None, size)
+	label = s.loop()
+	s.add_address(-1)
+	s.endloop(label)
+	s.exit()
+	return s, ''
+
+# Long output written with printstr
+def build_printstr(size):
+	s = whitespac3.WhiteSpace()
+	text = ('The quick brown fox jumps over the lazy dog.\n' * (size // 45 + 1))[:size]
+	s.printstr(text)
+	s.exit()
+	return s, ''
+
+# The same output, with the strings packed in numbers
+def build_printdata(size):
+	s = whitespac3.WhiteSpace(string_data=True)
+	text = ('The quick brown fox jumps over the lazy dog.\n' * (size // 45 + 1))[:size]
+	s.printstr(text)
+	s.exit()
+	return s, ''
+
+# Reads a long line with stringin and prints its length
+def build_stringin(size):
+	s = whitespac3.WhiteSpace()
+	s.stringin()
+	s.retrieve()
+	s.printnum()
+	s.exit()
+	return s, 'x' * size + '\n'
+
+# Loop over nested compare/ifstate chains
+def build_compare(size):
+	s = whitespac3.WhiteSpace()
+	s.store(None, size)
+	label = s.loop()
+	ends = []
+	for value, comparison in ((size // 2, '<'), (size // 4, '>'), (size // 8, '!=')):
+		s.dupl()
+		s.retrieve()
+		s.push(value)
+		if comparison == '!=':
+			s.compare('==')
+			s.push(1)
+			s.swap()
+			s.sub()
+		else:
+			s.compare(comparison)
+		ends.append(s.ifstate())
+	s.push(1)
+	s.delete()
+	for end in reversed(ends):
+		s.endif(end)
+	s.add_address(-1)
+	s.endloop(label)
+	s.exit()
+	return s, ''
+
+# name: (builder, default size)
+benchmarks = {
+	'loop': (build_loop, 20000),
+	'printstr': (build_printstr, 20000),
+	'printdata': (build_printdata, 20000),
+	'stringin': (build_stringin, 20000),
+	'compare': (build_compare, 5000),
+}
+
+engines = ('interpret', 'compile')
+
+# Loads and runs a program. Returns the VM, once finished, and the
+# loading and running times.
+def run_program(code, data, engine):
+	vm = interpreter.WhitespaceVM(stdin=io.StringIO(data), stdout=io.StringIO(),
+			compile=(engine == 'compile'), interactive=False)
+	start = time.perf_counter()
+	vm.load(code)
+	loaded = time.perf_counter()
+	vm.run()
+	return vm, loaded - start, time.perf_counter() - loaded
+
+# Runs a benchmark. Returns one result per engine.
+def run_benchmark(name, size, repeat):
+	builder = benchmarks[name][0]
+	#
+	start = time.perf_counter()
+	s, data = builder(size)
+	code = str(s)
+	generation_time = time.perf_counter() - start
+	#
+	results = []
+	instructions = None
+	for engine in engines:
+		wall_time = load_time = run_time = None
+		for i in range(repeat):
+			vm, load, run = run_program(code, data, engine)
+			if wall_time is None or load + run < wall_time:
+				wall_time, load_time, run_time = load + run, load, run
+			if engine == 'interpret':
+				instructions = vm.steps
+		#
+		tracemalloc.start()
+		run_program(code, data, engine)
+		peak_memory = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+		#
+		results.append({
+			'benchmark': name,
+			'engine': engine,
+			'size': size,
+			'instructions': instructions,
+			'wall_time': wall_time,
+			'load_time': load_time,
+			'run_time': run_time,
+			'instructions_per_second': instructions / run_time,
+			'peak_memory': peak_memory,
+			'code_size': len(code),
+			'generation_time': generation_time,
+		})
+	return results
+
+# Returns the current git commit, or None
+def git_commit():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+				stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+# Prints the results, with the speed ratio against a previous run
+def print_results(results, baseline=None, out=sys.stdout):
+	previous = {}
+	if baseline is not None:
+		for result in baseline['results']:
+			previous[result['benchmark'], result['engine']] = result
+	#
+	out.write("%-10s %-10s %10s %12s %9s %9s %10s %10s %9s\n" % ('benchmark', 'engine', 'instr', 'instr/s',
+			'load', 'run', 'memory', 'code', 'generate'))
+	for result in results:
+		line = "%-10s %-10s %10d %12.0f %8.3fs %8.3fs %9.1fK %9.1fK %8.3fs" % (result['benchmark'], result['engine'],
+				result['instructions'], result['instructions_per_second'], result['load_time'], result['run_time'],
+				result['peak_memory'] / 1024.0, result['code_size'] / 1024.0, result['generation_time'])
+		old = previous.get((result['benchmark'], result['engine']))
+		if old is not None:
+			line += "  x%.2f" % (result['instructions_per_second'] / old['instructions_per_second'])
+		out.write(line + "\n")
+
+def main():
+	parser = optparse.OptionParser(usage="%prog [options] [benchmark ...]")
+	parser.add_option("-r", "--repeat",  type="int", default=3, help="Runs of each benchmark, the fastest is kept")
+	parser.add_option("-q", "--quick",  action="store_true", default=False, help="Use programs ten times smaller")
+	parser.add_option("-o", "--output",  default=None, help="Write the results to this JSON file")
+	parser.add_option("--compare",  default=None, help="Show the speedup against the results in this JSON file")
+
+	(opts, args) = parser.parse_args()
+	names = args or sorted(benchmarks)
+	for name in names:
+		if name not in benchmarks:
+			parser.error("unknown benchmark %s (choose from %s)" % (name, ", ".join(sorted(benchmarks))))
+
+	results = []
+	for name in names:
+		size = benchmarks[name][1]
+		if opts.quick:
+			size //= 10
+		results += run_benchmark(name, size, opts.repeat)
+
+	baseline = None
+	if opts.compare is not None:
+		f = open(opts.compare)
+		baseline = json.load(f)
+		f.close()
+	print_results(results, baseline)
+
+	if opts.output is not None:
+		f = open(opts.output, 'w')
+		json.dump({'commit': git_commit(), 'python': sys.version, 'results': results}, f, indent=1)
+		f.close()
+
+if __name__ == '__main__':
+	main()
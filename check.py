@@ -0,0 +1,358 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Differential checks of the interpreter and of the WhiteSpace code
+# generator.
+#
+# Each program is run with every way the VM has to run it (step by step,
+# the fast loop with superinstructions, compiled, profiled, stopped and
+# resumed from snapshots, and as a coroutine), and the output and the
+# failure of each run must be the same as step by step. The programs
+# built with the generator are also built with its options and passes
+# (optimize, prune, assign_labels), which must not change the output.
+#
+#     python3 check.py
+#     python3 check.py -v
+
+import asyncio
+import io
+import optparse
+import os
+import sys
+import tempfile
+
+import interpreter
+import whitespac3
+
+################################################################
+# Programs written instruction by instruction
+
+# Returns the whitespace code of a program given as instructions of the
+# interpreter, separated by ';'. Labels are given by name.
+def assemble(source):
+	labels = {}
+	code = []
+	for line in source.split(';'):
+		words = line.split()
+		if not words:
+			continue
+		name = words[0].upper()
+		encoding, param, description = interpreter.instructions[name]
+		code.append(''.join(map(chr, encoding)))
+		if param == interpreter.PARAM_NUM:
+			n = int(words[1])
+			code.append(('\t' if n < 0 else ' ') + bin(abs(n))[2:].replace('0', ' ').replace('1', '\t') + '\n')
+		elif param == interpreter.PARAM_LABEL:
+			label = labels.setdefault(words[1], len(labels))
+			code.append(bin(label + 1)[3:].replace('0', ' ').replace('1', '\t') + '\n')
+	return ''.join(code)
+
+# name: (instructions, input)
+programs = {
+	'copy': ('push 5; scopy 0; add; out-num; end', ''),
+	'copy-deep': ('push 5; push 7; scopy 1; out-num; out-num; out-num; end', ''),
+	'slide': ('push 1; push 2; push 3; sslide 2; out-num; push 4; sslide 0; out-num; out-num; end', ''),
+	'swap-discard': ('push 1; push 2; sswap; sdiscard; out-num; end', ''),
+	'arithmetic': ('push -7; push 2; div; out-num; push -7; push 2; mod; out-num; push 7; push -2; mul; out-num; end', ''),
+	'division-by-zero': ('push 1; out-num; push 1; push 0; div; out-num; end', ''),
+	'out-char': ('push 72; out-char; push 955; out-char; push 10; out-char; end', ''),
+	'dead-out-char': ('push 1; out-num; end; label dead; push -1; out-char; end', ''),
+	'bad-out-char': ('push 1; out-num; push -1; out-char; end', ''),
+	'heap': ('push 1000000; push 3; store; push 1099511627776; push 4; store; push 7; push 1180591620717411303424; store;'
+			'push 1000000; retrieve; out-num; push 1099511627776; retrieve; out-num; push 7; retrieve; out-num;'
+			'push 12345; retrieve; out-num; end', ''),
+	'negative-address': ('push -1; push 1; store; end', ''),
+	'loop': ('push 0; push 10; store; label top; push 0; sdupli; retrieve; push -1; add; store;'
+			'push 0; retrieve; sdupli; out-num; jump-zero end; jump top; label end; end', ''),
+	'fused-loop': ('push 1; push 3; store; push 1; label top; sdupli; retrieve; jump-zero end;'
+			'sdupli; sdupli; retrieve; push -1; add; store; push 46; out-char; jump top; label end; end', ''),
+	'call': ('push 3; call twice; out-num; end; label twice; push 2; mul; return', ''),
+	'recursion': ('push 5; call count; end; label count; sdupli; jump-zero done; sdupli; out-num; push -1; add;'
+			'call count; label done; return', ''),
+	'return-empty': ('push 1; out-num; return', ''),
+	'underflow': ('push 1; out-num; add; end', ''),
+	'unknown-label': ('push 1; out-num; jump nowhere', ''),
+	'no-end': ('push 1; out-num', ''),
+	'in-char': ('push 0; in-char; push 1; in-char; push 1; retrieve; out-char; push 0; retrieve; out-num; end', 'ab'),
+	'in-char-eof': ('push 0; in-char; push 0; retrieve; out-num; push 0; in-char; end', 'a'),
+	'in-num': ('push 0; in-num; push 1; in-num; push 0; retrieve; push 1; retrieve; add; out-num; end', '12\n-5\n'),
+	'in-num-invalid': ('push 0; in-num; push 0; retrieve; out-num; push 0; in-num; end', '7\nseven\n'),
+}
+
+# Programs that never end, which run_steps must stop
+endless = {
+	'jump': 'label top; push 1; sdiscard; jump top',
+	'jump-zero': 'push 0; label top; sdupli; jump-zero top',
+	'jump-neg': 'push -1; label top; sdupli; jump-neg top',
+	'call': 'label top; call top',
+	'loop-test': 'push 1; label top; sdupli; retrieve; jump-zero top',
+}
+
+################################################################
+# Programs built with the generator
+
+def build_compare(s):
+	for comparison in ('==', '<', '>', '<=', '>='):
+		for a, b in ((1, 2), (2, 2), (3, 2), (-1, 0)):
+			s.push(a)
+			s.push(b)
+			s.compare(comparison)
+			s.printnum()
+	s.exit()
+	return ''
+
+def build_loop(s):
+	s.store(None, 5)
+	label = s.loop()
+	s.printstr('tick ')
+	s.add_address(-1)
+	s.endloop(label)
+	label = s.repeat(3)
+	s.dupl()
+	s.printnum()
+	s.endrepeat(label)
+	s.exit()
+	return ''
+
+def build_strings(s):
+	s.printstr('What is your name?\n')
+	s.stringin()
+	s.printstr('Hello, ')
+	s.printstr()
+	s.printstr('!\n')
+	s.stringin()
+	s.printstr()
+	s.exit()
+	return 'Ada\nand more\n'
+
+def build_variables(s):
+	s.new_num(3)
+	s.setvar('total', 10)
+	s.getvar('total')
+	s.printnum()
+	s.push(4)
+	s.setvar('total')
+	s.retrieve()
+	s.getvar('total')
+	s.add()
+	s.printnum()
+	s.numin()
+	s.printnum()
+	s.exit()
+	return '41\n'
+
+def build_heap(s):
+	for n in (3, 4, 5):
+		s.new_num(n)
+	s.store(None, 9)
+	s.retrieve()
+	s.printnum()
+	s.add()
+	s.printnum()
+	label = s.loop()
+	s.printstr('.')
+	s.add_address(-1)
+	s.endloop(label)
+	s.new_num(7)
+	s.retrieve()
+	s.printnum()
+	s.exit()
+	return ''
+
+# Stores to one address twice, with another store in between
+def build_stores(s):
+	s.setvar('a', 1)
+	s.setvar('b', 0)
+	s.setvar('b', 3)
+	s.setvar('a', 1)
+	s.getvar('a')
+	s.printnum()
+	s.getvar('b')
+	s.printnum()
+	s.exit()
+	return ''
+
+# Stores again on the path that doesn't jump, and reads after both
+def build_branch(s):
+	s.setvar('a', 1)
+	s.push(0)
+	end = s.ifstate()
+	s.setvar('a', 2)
+	s.endif(end)
+	s.getvar('a')
+	s.printnum()
+	s.push(1)
+	end = s.ifstate()
+	s.setvar('a', 3)
+	s.endif(end)
+	s.getvar('a')
+	s.printnum()
+	s.exit()
+	return ''
+
+# name: builder, which returns the input
+generated = {
+	'branch': build_branch,
+	'compare': build_compare,
+	'heap': build_heap,
+	'loop': build_loop,
+	'stores': build_stores,
+	'strings': build_strings,
+	'variables': build_variables,
+}
+
+# The options of the generator and the passes run after building
+variants = (
+	({}, ()),
+	({}, ('optimize',)),
+	({}, ('optimize', 'prune', 'assign_labels')),
+	({'call': True}, ('optimize', 'prune', 'assign_labels')),
+	({'string_data': True}, ('prune',)),
+	({'static': True}, ('optimize', 'prune')),
+)
+
+# Returns the code of a generated program and its input
+def generate(builder, options, passes):
+	s = whitespac3.WhiteSpace(explain=False, **options)
+	data = builder(s)
+	for name in passes:
+		getattr(s, name)()
+	return s.string, data
+
+################################################################
+# Ways of running a program. Each one writes the output to out, a text
+# stream, so that it's kept when the program fails.
+
+# StreamWriter of run_async, writing to a text stream
+class Writer:
+	def __init__(self, out):
+		self.out = out
+
+	def write(self, data):
+		self.out.write(data.decode('utf-8'))
+
+	async def drain(self):
+		pass
+
+def run_step(code, data, out):
+	vm = interpreter.WhitespaceVM(stdin=io.StringIO(data), stdout=out, interactive=False)
+	try:
+		vm.load(code)
+		while not vm.finished:
+			vm.step()
+	finally:
+		vm.flush_output()
+
+def run_fast(code, data, out, **options):
+	vm = interpreter.WhitespaceVM(stdin=io.StringIO(data), stdout=out, interactive=False, **options)
+	vm.load(code)
+	vm.run()
+
+def run_compiled(code, data, out):
+	run_fast(code, data, out, compile=True)
+
+def run_profiled(code, data, out):
+	run_fast(code, data, out, profile=True)
+
+# Stops every few instructions, and goes on in a new VM from a snapshot
+def run_snapshots(code, data, out):
+	directory = tempfile.mkdtemp()
+	path = os.path.join(directory, 'check.wss')
+	try:
+		vm = interpreter.WhitespaceVM(stdin=io.StringIO(data), stdout=out, interactive=False)
+		vm.load(code)
+		while not vm.run_steps(5):
+			vm.save_snapshot(path)
+			vm = interpreter.WhitespaceVM(stdin=io.StringIO(data), stdout=out, interactive=False)
+			vm.load_snapshot(path)
+	finally:
+		if os.path.exists(path):
+			os.remove(path)
+		os.rmdir(directory)
+
+def run_async(code, data, out):
+	async def session():
+		reader = asyncio.StreamReader()
+		reader.feed_data(data.encode('utf-8'))
+		reader.feed_eof()
+		vm = interpreter.WhitespaceVM(interactive=False)
+		vm.load(code)
+		await vm.run_async(reader, Writer(out), 7)
+	asyncio.run(session())
+
+runners = {
+	'fast': run_fast,
+	'compile': run_compiled,
+	'profile': run_profiled,
+	'snapshots': run_snapshots,
+	'async': run_async,
+}
+
+# Runs a program. Returns its output and the exception it raised, if
+# any: InterpreterException is the only one a program may raise.
+def capture(runner, code, data):
+	out = io.StringIO()
+	try:
+		runner(code, data, out)
+	except interpreter.InterpreterException:
+		return out.getvalue(), 'InterpreterException'
+	except Exception as e:
+		return out.getvalue(), '%s: %s' % (type(e).__name__, e)
+	return out.getvalue(), None
+
+# Runs a program every way. Returns the differences with running it
+# step by step.
+def check_program(code, data):
+	expected = capture(run_step, code, data)
+	problems = []
+	if expected[1] not in (None, 'InterpreterException'):
+		problems.append("step: raised %s" % expected[1])
+	for name in sorted(runners):
+		result = capture(runners[name], code, data)
+		if result != expected:
+			problems.append("%s: %r, expected %r" % (name, result, expected))
+	return problems
+
+def main():
+	parser = optparse.OptionParser(usage="%prog [options]")
+	parser.add_option("-v", "--verbose",  action="store_true", default=False, help="Show every program checked")
+	(opts, args) = parser.parse_args()
+
+	checks = []
+	for name in sorted(programs):
+		source, data = programs[name]
+		checks.append((name, assemble(source), data, None))
+	for name in sorted(generated):
+		code, data = generate(generated[name], {}, ())
+		expected = capture(run_step, code, data)
+		for options, passes in variants:
+			code, data = generate(generated[name], options, passes)
+			checks.append(('%s %s %s' % (name, options, '+'.join(passes)), code, data, expected))
+
+	failures = 0
+	for name in sorted(endless):
+		vm = interpreter.WhitespaceVM(stdin=io.StringIO(''), stdout=io.StringIO())
+		vm.load(assemble(endless[name]))
+		vm.run_steps(1000)
+		if vm.steps > 1010:
+			failures += 1
+			sys.stdout.write("FAIL endless %s: stopped after %d instructions, not 1000\n" % (name, vm.steps))
+		elif opts.verbose:
+			sys.stdout.write("ok   endless %s\n" % name)
+	for name, code, data, expected in checks:
+		problems = check_program(code, data)
+		result = capture(run_step, code, data)
+		if expected is not None and result != expected:
+			problems.append("generated: %r, expected %r" % (result, expected))
+		if problems:
+			failures += 1
+			sys.stdout.write("FAIL %s\n" % name)
+			for problem in problems:
+				sys.stdout.write("     %s\n" % problem)
+		elif opts.verbose:
+			sys.stdout.write("ok   %s\n" % name)
+	sys.stdout.write("%d checks, %d failed\n" % (len(checks) + len(endless), failures))
+	sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+	main()
@@ -22,13 +22,23 @@
 
 __author__  = '''Miguel Colom'''
 __docformat__ = 'plaintext'
+__version__ = '2.0'
 
+import array
+import asyncio
+import codecs
+import hashlib
+import io
+import json
+import marshal
+import mmap
 import optparse
+import os
+import re
+import stat
 import sys
-
-G_verbose = False
-G_stack = False
-G_pause = False
+import time
+import zlib
 
 SPACE = ord(' ')
 TAB = ord('\t')
@@ -82,364 +92,1984 @@ instructions = {
 	'IN-NUM': ((TAB, LF, TAB, TAB), PARAM_NONE, 'Read a number and place it in the location given by the top of the stack')
 }
 
-# Checks if the IP points to a valid instruction
-def format_compatible(format, memory, ip):
-	for i in range(len(format)):
-		if format[i] != memory[ip+i]:
-			return False
-	return True
+# Characters of a program that are not instructions
+NOT_WHITESPACE = bytes(c for c in range(256) if c not in (SPACE, TAB, LF))
 
-# Returns the name of the instruction pointed by IP or '' if it's not a
-# valid instruction
-def identify_instruction(memory, ip):
-	for name in list(instructions.keys()):
-		instruction_def = instructions[name]
-		format = instruction_def[0]
-		#
-		# Check format compatibility
-		if format_compatible(format, memory, ip):
-			return name
-	#
-	# Not found
-	return ''
-
-# Decodes the number pointed by IP
-def decode_num(memory, ip):
-	bits = []
-
-	i = ip
-	ch = memory[i]
-	while ch != LF:
-		if ch == SPACE:
-			bits.append(0)
-		elif ch == TAB:
-			bits.append(1)
-		#
-		i += 1
-		ch = memory[i]
+# Builds a regular expression matching an instruction and its operand,
+# on the whitespace characters of a program. The groups 2*i+1 and 2*i+2
+# are the encoding and the operand (empty if there is none) of the ith
+# instruction of the returned list of names.
+def build_instruction_regex(instructions):
+	names = sorted(instructions)
+	parts = []
+	for name in names:
+		encoding, param = instructions[name][:2]
+		operand = b'[ \t]*\n' if param in (PARAM_NUM, PARAM_LABEL) else b''
+		parts.append(b'(' + bytes(encoding) + b')(' + operand + b')')
+	return names, re.compile(b'|'.join(parts))
 
-	length = len(bits) + 1 # +1 because of the final LF
+instruction_names, instruction_regex = build_instruction_regex(instructions)
 
-	number = 0
-	multiplier = 1
-	while len(bits) > 1:
-		b = bits.pop()
-		number += b * multiplier
-		multiplier *= 2
+# The bits of a number
+BINARY_DIGITS = bytes.maketrans(b' \t', b'01')
 
-	# Get sign and multiply
-	sign = (+1 if bits.pop() == 0 else -1)
-	number *= sign
-	#
-	return number, length
+# Decodes a number from its sign, bits and final LF
+def decode_num(operand):
+	number = int(operand[1:-1].translate(BINARY_DIGITS) or b'0', 2)
+	return -number if operand[0] == TAB else number
 
 # Retrieves a label from the location at IP
 def get_label(memory, ip):
-	label = ''
-
-	i = ip
-	v = memory[i]
-	
-	while v != LF:
-		if v == SPACE or v == TAB:
-			label += chr(v)			
+	end = memory.index(LF, ip) + 1 # Include the final LF
+	label = ''.join(map(chr, memory[ip:end]))
+	return label, len(label)
+
+# Returns a label in a readable form, with S for space and T for tab
+def label_name(label):
+	return label[:-1].replace(' ', 'S').replace('\t', 'T') or '<empty>'
+
+
+# Decodes the program in memory (its whitespace characters) into a list
+# of (name, operand, ip) records, where ip is the address of the
+# instruction in memory. The operands of the
+# flow control instructions are resolved to the index of the instruction
+# following the LABEL, or None if the label is not defined.
+def decode_program(memory, program_length):
+	program = []
+	labels = {}
+	references = []
+
+	# The characters that don't start an instruction are skipped
+	for match in instruction_regex.finditer(bytes(memory), 0, program_length):
+		group = match.lastindex
+		name = instruction_names[group // 2 - 1]
+		param = instructions[name][1]
+		if param == PARAM_NUM:
+			operand = decode_num(match.group(group))
+		elif param == PARAM_LABEL:
+			operand = match.group(group).decode('ascii')
+			if name == 'LABEL':
+				if operand not in labels: # Only the first is considered
+					labels[operand] = len(program) + 1
+			else:
+				references.append(len(program))
+		else:
+			operand = None
 		#
+		program.append((name, operand, match.start()))
+
+	# Resolve labels into instruction indices
+	for i in range(len(program)):
+		name, operand, instruction_ip = program[i]
+		if name == 'LABEL':
+			program[i] = (name, labels[operand], instruction_ip)
+	for i in references:
+		name, operand, instruction_ip = program[i]
+		program[i] = (name, labels.get(operand), instruction_ip)
+	#
+	return program, labels
+
+# Checks the labels of a decoded program. Returns the (ip, message) of
+# the LABELs defined again, which are ignored, and of the instructions
+# referring to labels that are not defined.
+def check_labels(memory, program):
+	problems = []
+	for pc in range(len(program)):
+		name, arg, ip = program[pc]
+		if name == 'LABEL':
+			if arg != pc + 1:
+				label, length = get_label(memory, ip + len(instructions[name][0]))
+				problems.append((ip, "Label %s defined again, first at ip=%d" % (label_name(label), program[arg - 1][2])))
+		elif arg is None and instructions[name][1] == PARAM_LABEL:
+			label, length = get_label(memory, ip + len(instructions[name][0]))
+			problems.append((ip, "Label %s of %s not defined" % (label_name(label), name)))
+	return problems
+
+# Builds the exception for a flow control instruction with an unknown label
+def unknown_label(memory, ip, name, action):
+	label, length = get_label(memory, ip + len(instructions[name][0]))
+	return InterpreterException(ip, "Unknown label: " +
+				"{0}".format(label).replace("\t", "[Tab]").replace("\n", "[LF]").replace(" ", "[space]") +
+				"\nOR %s without correct label" % action)
+
+# Marks the operand of a superinstruction pattern that becomes the
+# operand of the superinstruction
+FUSED_OPERAND = 'n'
+
+# Superinstructions: sequences of instructions that the WhiteSpace
+# generator emits again and again, executed with a single dispatch.
+# The pattern gives the (name, operand) of each instruction.
+superinstructions = {
+	# add_address(n): dupl, dupl, retrieve, push n, add, store
+	'ADD-ADDRESS': ((('SDUPLI', None), ('SDUPLI', None), ('RETRIEVE', None), ('PUSH', FUSED_OPERAND),
+				('ADD', None), ('STORE', None)), PARAM_NUM, 'Add n to the heap cell at the address on the top of the stack'),
+	# heapidx(n): push 0, retrieve, dupl, push n, add, push 0, swap, store
+	'HEAPIDX': ((('PUSH', 0), ('RETRIEVE', None), ('SDUPLI', None), ('PUSH', FUSED_OPERAND), ('ADD', None),
+				('PUSH', 0), ('SSWAP', None), ('STORE', None)), PARAM_NUM, 'Push the heap index and add n to it'),
+	# loop(): dupl, retrieve, jump-zero
+	'LOOP-TEST': ((('SDUPLI', None), ('RETRIEVE', None), ('JUMP-ZERO', FUSED_OPERAND)), PARAM_LABEL,
+				'Jump to a label if the heap cell at the address on the top of the stack is zero'),
+}
+
+# Returns the operand of the superinstruction whose pattern is found at
+# index i of the program, or None if it's not there
+def match_superinstruction(program, i, pattern):
+	if i + len(pattern) > len(program):
+		return None
+	operand = None
+	for k in range(len(pattern)):
+		name, arg, ip = program[i + k]
+		pattern_name, pattern_arg = pattern[k]
+		if name != pattern_name:
+			return None
+		if pattern_arg == FUSED_OPERAND:
+			operand = arg
+		elif arg != pattern_arg:
+			return None
+	return operand
+
+# Replaces the superinstruction patterns of a decoded program. Returns the
+# new program and the number of fusions. The superinstruction takes the
+# place of the first instruction of the pattern and the others are kept,
+# so the indices don't change. None of them can be a jump target, as
+# the patterns don't contain a LABEL.
+def fuse_program(program):
+	by_first = {}
+	for name in superinstructions:
+		by_first.setdefault(superinstructions[name][0][0][0], []).append(name)
+	#
+	fused = list(program)
+	fusions = 0
+	i = 0
+	while i < len(program):
+		for name in by_first.get(program[i][0], ()):
+			pattern = superinstructions[name][0]
+			if i + 1 < len(program) and program[i + 1][0] != pattern[1][0]:
+				continue
+			operand = match_superinstruction(program, i, pattern)
+			if operand is not None:
+				fused[i] = (name, operand, program[i][2])
+				fusions += 1
+				i += len(pattern) - 1
+				break
 		i += 1
-		v = memory[i]
-
-    # Add the final LF
-	label += chr(v)
-
-	length = len(label)
-	return label, length
-
-# Reads a character from stdin
-def in_char():
-	return sys.stdin.read(1)
-
-# Outputs a string to stdout
-def out_string(string):
-	sys.stdout.write(string)
-
-# Executes a single instruction	
-def exec_instruction(name, num, label, label_length, ip, memory, stack, call_stack, labels):
-	new_ip = -1
-	finished = False
-
-	# *** Stack Manipulation ***
-	if name == 'PUSH':
-		stack.append(num)
-	elif name == 'SDUPLI':
-		if len(stack) < 1:
-			raise InterpreterException(ip, "SDUPLI with empty stack")
-		stack.append(stack[-1])
-	elif name == 'SCOPY':
-		pos = len(stack)-num-1
-		if pos < 0:
-		  raise InterpreterException(ip, "SCOPY with negative argument")
-		stack.append(stack[pos])
-	elif name == 'SSWAP':
-		if len(stack) < 2:
-			raise InterpreterException(ip, "SSWAP with less than two elements")
-		n1 = stack.pop()
-		n2 = stack.pop()
-		stack.append(n1)
-		stack.append(n2)
-	elif name == 'SDISCARD':
-		if len(stack) > 0:
-			stack.pop()
-	elif name == 'SSLIDE':
-		if len(stack) > 0:
-			top = stack.pop()
-			for i in range(num):
-				stack.pop()
-			stack.append(top) # Recover top
+	return fused, fusions
+
+################################################################
+# Static stack verification
+#
+# Before running a program, the depth of its stack is bounded for each
+# instruction, following all the paths of the control flow graph (a
+# RETURN may go back after any CALL). When the lower bound is enough
+# for an instruction, its underflow check can be skipped, and when the
+# upper bound is not, it will fail whenever it runs.
+
+UNBOUNDED = float('inf')
+
+# Items needed on the stack and change of the stack depth of the
+# instructions. SCOPY, SDISCARD and SSLIDE depend on the stack.
+stack_effects = {
+	'PUSH': (0, 1), 'SDUPLI': (1, 1), 'SSWAP': (2, 0),
+	'ADD': (2, -1), 'SUB': (2, -1), 'MUL': (2, -1), 'DIV': (2, -1), 'MOD': (2, -1),
+	'STORE': (2, -2), 'RETRIEVE': (1, 0),
+	'LABEL': (0, 0), 'CALL': (0, 0), 'JUMP': (0, 0), 'JUMP-ZERO': (1, -1), 'JUMP-NEG': (1, -1),
+	'RETURN': (0, 0), 'END': (0, 0),
+	'OUT-CHAR': (1, -1), 'OUT-NUM': (1, -1), 'IN-CHAR': (1, -1), 'IN-NUM': (1, -1),
+}
+
+# Returns the items needed by an instruction, or None if it can't be known
+def stack_needed(name, arg):
+	if name == 'SCOPY':
+		return arg + 1 if arg >= 0 else None
+	if name in ('SDISCARD', 'SSLIDE'):
+		return 0
+	return stack_effects[name][0]
+
+# Returns the lower and upper bounds of the stack depth after an
+# instruction, from the bounds before it
+def stack_after(name, arg, low, high):
+	if name == 'SCOPY':
+		return max(low, arg + 1) + 1, high + 1
+	if name == 'SDISCARD':
+		return max(low - 1, 0), max(high - 1, 0)
+	if name == 'SSLIDE':
+		n = max(arg, 0)
+		return (max(low - n, 1) if low > 0 else 0), max(high - n, 0)
+	need, change = stack_effects[name]
+	return max(low, need) + change, high + change
+
+# The instructions that may not be followed by the next one
+flow_instructions = ('CALL', 'JUMP', 'JUMP-ZERO', 'JUMP-NEG', 'RETURN', 'END')
+
+# Returns the indices an instruction can be followed by. The return
+# points are the indices following the CALLs.
+def successors(program, pc, return_points):
+	name, arg, ip = program[pc]
+	if name == 'END':
+		return ()
+	if name == 'RETURN':
+		return return_points
+	if name in ('JUMP', 'CALL'):
+		return (arg,) if arg is not None else ()
+	if name in ('JUMP-ZERO', 'JUMP-NEG') and arg is not None:
+		return (pc + 1, arg)
+	return (pc + 1,)
+
+# Bounds the stack depth before each instruction of a decoded program.
+# Returns the list of the instructions whose underflow check can be
+# skipped (True) and the list of (ip, message) of those that always
+# fail when they are reached.
+def verify_stack(program):
+	size = len(program)
+	needs = [stack_needed(name, arg) for name, arg, ip in program]
+	low = [UNBOUNDED] * size # Not reached yet
+	high = [-1] * size
+	return_points = tuple(pc + 1 for pc in range(size)
+				if program[pc][0] == 'CALL' and program[pc][1] is not None and pc + 1 < size)
 	#
-	# *** Arithmetic ***
-	elif name == 'ADD':
-		stack.append(stack.pop() + stack.pop())
-	elif name == 'SUB':
-		if len(stack) < 2:
-			raise InterpreterException(ip, "SUB with less than two elements")
-		n1 = stack.pop()
-		n2 = stack.pop()
-		stack.append(n2 - n1)
-	elif name == 'MUL':
-		if len(stack) < 2:
-			raise InterpreterException(ip, "MUL with less than two elements")
-		stack.append(stack.pop() * stack.pop())
-	elif name == 'DIV':
-		if len(stack) < 2:
-			raise InterpreterException(ip, "DIV with less than two elements")
-		n1 = stack.pop()
-		n2 = stack.pop()
-		stack.append(n2 / n1)
-	elif name == 'MOD':
-		if len(stack) < 2:
-			raise InterpreterException(ip, "MOD with less than two elements")
-		n1 = stack.pop()
-		n2 = stack.pop()
-		stack.append(n2 % n1)
-	# *** Heap Access ***
-	elif name == 'STORE':
-		if len(stack) < 2:
-			raise InterpreterException(ip, "STORE with less than two elements")
-		value = stack.pop()
-		addr = stack.pop()
-		memory[addr] = value
-	elif name == 'RETRIEVE':
-		if len(stack) < 1:
-			raise InterpreterException(ip, "RETREIVE with empty stack")
-		n = stack.pop()
-		stack.append(memory[n])
-	# *** Flow Control ***
-	elif name == 'LABEL':
-		labels[label] = ip + len(label)
-	elif name == 'CALL':
-		try:
-			new_ip = labels[label]
-		except KeyError:
-			raise InterpreterException(ip, "Unknown label: " + 
-						"{0}".format(label).replace("\t", "[Tab]").replace("\n", "[LF]").replace(" ", "[space]") +
-						"\nOR calling without correct label")
-		call_stack.append(ip + label_length)
-	elif name == 'JUMP':
-		try:
-			new_ip = labels[label]
-		except KeyError:
-			raise InterpreterException(ip, "Unknown label: " + 
-						"{0}".format(label).replace("\t", "[Tab]").replace("\n", "[LF]").replace(" ", "[space]") +
-						"\nOR jumping without correct label")
-	elif name == 'JUMP-ZERO':
-		if len(stack) < 1:
-			raise InterpreterException(ip, "JUMP-ZERO with empty stack")
-		test = stack.pop()
-		if test == 0:
-			new_ip = labels[label]
-	elif name == 'JUMP-NEG':
-		if len(stack) < 1:
-			raise InterpreterException(ip, "JUMP-NEG with empty stack")
-		test = stack.pop()
-		if test < 0:
-			new_ip = labels[label]
-	elif name == 'RETURN':
-		if len(call_stack) < 1:
-			raise InterpreterException(ip, "RETURN with empty call_stack")
-		new_ip = call_stack.pop()
-	elif name == 'END':
-		finished = True
-	# *** I/O ***
-	elif name == 'OUT-NUM':
-		if len(stack) < 1:
-			raise InterpreterException(ip, "OUT-NUM with empty stack")
-		string = '%s' % stack.pop()
-		out_string(string)
-	elif name == 'OUT-CHAR':
-		if len(stack) < 1:
-			raise InterpreterException(ip, "OUT-CHAR with empty stack")
-		string = '%c' % stack.pop()
-		out_string(string)
-	elif name == 'IN-NUM':
-		if len(stack) < 1:
-			raise InterpreterException(ip, "IN-NUM with empty stack")
-		is_number = False
-		while not is_number:
-			try:			
-				string = sys.stdin.readline()
-				string = string.replace('\n', '')
-				number = int(string)
-				is_number = True
-			except ValueError:
-				print ("[INTERPRETER] Please enter a number")
-				is_number = False
-		#
-		addr = stack.pop()
-		memory[addr] = number
-	elif name == 'IN-CHAR':
-		if len(stack) < 1:
-			raise InterpreterException(ip, "IN-CHAR with empty stack")
-		c = in_char()
-		addr = stack.pop()
-		memory[addr] = ord(c)
+	pending = []
+	if size > 0:
+		low[0] = high[0] = 0
+		pending.append(0)
+	while pending:
+		pc = pending.pop()
+		# Follow the code while it changes the bounds, keeping the other
+		# successors for later
+		while pc is not None:
+			name, arg, ip = program[pc]
+			need = needs[pc]
+			if need is None or high[pc] < need:
+				break # Fails here
+			if name in stack_effects:
+				change = stack_effects[name][1]
+				after_low = max(low[pc], need) + change
+				after_high = high[pc] + change
+			else:
+				after_low, after_high = stack_after(name, arg, low[pc], high[pc])
+			if name in flow_instructions:
+				next_pcs = successors(program, pc, return_points)
+			else:
+				next_pcs = (pc + 1,)
+			pc = None
+			for next_pc in next_pcs:
+				if next_pc >= size:
+					continue
+				changed = False
+				if after_low < low[next_pc]:
+					low[next_pc] = after_low
+					changed = True
+				if high[next_pc] < 0:
+					high[next_pc] = after_high
+					changed = True
+				elif after_high > high[next_pc]:
+					high[next_pc] = UNBOUNDED # Grows in a loop
+					changed = True
+				if changed:
+					if pc is None:
+						pc = next_pc
+					else:
+						pending.append(next_pc)
 	#
-	return new_ip, finished
-	
-# Prints a debug message
-def print_verbose(string):
-	if G_verbose:
-		out_string("[INFO] " + string + "\n")
-
-# Looks for labels and maps them with their locations
-def find_and_execute_labels(labels, memory, instructions, stack, call_stack, program_length):
-	ip = 0
-	while ip < program_length:
-		name = identify_instruction(memory, ip)
-		if name == 'LABEL':
-			instruction_def = instructions[name]
-			addr_instr = ip
-			addr_label = ip + len(instruction_def[0])
-			label, length = get_label(memory, addr_label)
-			if label not in labels: # Only the first is considered
-				num = None
-				exec_instruction(name, num, label, length, addr_label, memory, stack, call_stack, labels)
-			ip = addr_instr
+	safe = [False] * size
+	underflows = []
+	for pc in range(size):
+		need = needs[pc]
+		if need is None:
+			continue
+		safe[pc] = low[pc] >= need
+		if 0 <= high[pc] < need:
+			name, arg, ip = program[pc]
+			underflows.append((ip, "%s needs a stack depth of %d, it is at most %d" % (name, need, high[pc])))
+	return safe, underflows
+
+# Returns a copy of the program for WhitespaceVM.run_fast, where the
+# instructions that may underflow the stack are wrapped in CHECK
+# records, so that only them go through the checks
+def mark_checked(program, safe):
+	marked = list(program)
+	for pc in range(len(program)):
+		name, arg, ip = program[pc]
+		if name in instructions and not safe[pc] and stack_needed(name, arg) != 0:
+			marked[pc] = ('CHECK', (name, arg), ip)
+	return marked
+
+################################################################
+# Compilation backend
+#
+# The decoded program is split into blocks starting at the entry
+# points (the beginning, the LABEL targets and the CALL return
+# addresses). Each block is translated into a Python function that
+# returns the index of the next block to run, or -1 at END. Inside a
+# block the stack is simulated with Python expressions, so that the
+# values only go through the real stack when leaving the block.
+
+# Translates a single block of the program into Python source
+class BlockCompiler:
+	def __init__(self, program, entry, end):
+		self.program = program
+		self.entry = entry
+		self.end = end
+		self.lines = []
+		self.pending = [] # Stack items held in Python expressions
+		self.output = []  # Constant output not written yet
+		self.temps = 0
+		self.indent = 1
+		self.loop = False
+
+	# Adds a line of code, writing any pending constant output first
+	def emit(self, line):
+		if self.output:
+			text = ''.join(self.output)
+			self.output = []
+			self.emit('out_string(%r)' % text)
+		self.lines.append('\t' * self.indent + line)
+
+	# Stores the result of an expression in a new local variable
+	def temp(self, expr):
+		self.temps += 1
+		name = 't%d' % self.temps
+		self.emit('%s = %s' % (name, expr))
+		return name
+
+	# Returns the top n items of the stack, deepest first
+	def take(self, n):
+		items = []
+		while len(items) < n:
+			if self.pending:
+				items.insert(0, self.pending.pop())
+			else:
+				items.insert(0, self.temp('pop()'))
+		return items
+
+	# Moves the simulated items to the real stack
+	def flush(self):
+		if len(self.pending) == 1:
+			self.emit('push(%s)' % self.pending[0])
+		elif self.pending:
+			self.emit('stack.extend((%s,))' % ', '.join(self.pending))
+		del self.pending[:] # compile_instruction holds the list
+
+	# Returns the statement that transfers control to the target
+	def goto(self, target, name, ip, action):
+		if target is None:
+			return 'raise unknown_label(code, %d, %r, %r)' % (ip, name, action)
+		if target == self.entry:
+			self.loop = True
+			return 'continue'
+		return 'return %d' % target
+
+	def compile(self):
+		pc = self.entry
+		while pc < self.end:
+			name, arg, ip = self.program[pc]
+			pc += 1
+			if not self.compile_instruction(name, arg, pc, ip):
+				break # The rest of the block is unreachable
+		else:
+			self.flush()
+			self.emit('return %d' % self.end)
+		self.flush()
 		#
-		ip += 1
+		body = self.lines
+		if self.loop:
+			body = ['\twhile True:'] + ['\t' + line for line in body]
+		return ['def block_%d():' % self.entry] + body
+
+	# Translates an instruction. Returns False if control never
+	# reaches the next one.
+	def compile_instruction(self, name, arg, pc, ip):
+		pending = self.pending
+
+		# *** Stack Manipulation ***
+		if name == 'PUSH':
+			pending.append(repr(arg))
+		elif name == 'SDUPLI':
+			a, = self.take(1)
+			pending.extend((a, a))
+		elif name == 'SCOPY':
+			self.flush()
+			self.emit('if len(stack) < %d: raise InterpreterException(%d, "SCOPY with negative argument")' % (arg + 1, ip))
+			pending.append(self.temp('stack[%d]' % (-arg - 1)))
+		elif name == 'SSWAP':
+			a, b = self.take(2)
+			pending.extend((b, a))
+		elif name == 'SDISCARD':
+			if pending:
+				pending.pop()
+			else:
+				self.emit('if stack: pop()')
+		elif name == 'SSLIDE':
+			self.flush()
+			self.emit('if stack:')
+			self.emit('\ttop = pop()')
+			self.emit('\tfor i in range(%d): pop()' % arg)
+			self.emit('\tpush(top)')
+		#
+		# *** Arithmetic ***
+		elif name in arithmetic_operators:
+			a, b = self.take(2)
+			operator = arithmetic_operators[name]
+			if is_constant(a) and is_constant(b) and (name in ('ADD', 'SUB', 'MUL') or eval(b) != 0):
+				pending.append(repr(eval('%s %s %s' % (a, operator, b))))
+			else:
+				pending.append(self.temp('%s %s %s' % (a, operator, b)))
+		# *** Heap Access ***
+		elif name == 'STORE':
+			addr, value = self.take(2)
+			self.emit('store(%s, %s)' % (addr, value))
+		elif name == 'RETRIEVE':
+			addr, = self.take(1)
+			pending.append(self.temp('retrieve(%s)' % addr))
+		# *** Flow Control ***
+		elif name == 'LABEL':
+			pass
+		elif name == 'CALL':
+			self.flush()
+			if arg is not None:
+				self.emit('call_stack.append(%d)' % pc)
+			self.emit(self.goto(arg, name, ip, "calling"))
+			return False
+		elif name == 'JUMP':
+			self.flush()
+			self.emit(self.goto(arg, name, ip, "jumping"))
+			return False
+		elif name in ('JUMP-ZERO', 'JUMP-NEG'):
+			test, = self.take(1)
+			condition = '%s == 0' if name == 'JUMP-ZERO' else '%s < 0'
+			if is_constant(test):
+				if eval(condition % test):
+					self.flush()
+					self.emit(self.goto(arg, name, ip, "jumping"))
+					return False
+			else:
+				self.flush()
+				self.emit('if %s: %s' % (condition % test, self.goto(arg, name, ip, "jumping")))
+		elif name == 'RETURN':
+			self.flush()
+			self.emit('return call_stack.pop()')
+			return False
+		elif name == 'END':
+			self.flush()
+			self.emit('return -1')
+			return False
+		# *** I/O ***
+		elif name == 'OUT-NUM':
+			a, = self.take(1)
+			if is_constant(a):
+				self.output.append('%s' % eval(a))
+			else:
+				self.emit("out_string('%%s' %% %s)" % a)
+		elif name == 'OUT-CHAR':
+			a, = self.take(1)
+			if is_constant(a) and 0 <= eval(a) < 0x110000:
+				self.output.append('%c' % eval(a))
+			else:
+				self.emit("out_string('%%c' %% %s)" % a)
+		elif name == 'IN-NUM':
+			addr, = self.take(1)
+			number = self.temp('in_num()')
+			self.emit('if %s is None: raise InterpreterException(%d, "IN-NUM without a valid number")' % (number, ip))
+			self.emit('store(%s, %s)' % (addr, number))
+		elif name == 'IN-CHAR':
+			addr, = self.take(1)
+			c = self.temp('in_char()')
+			self.emit('if not %s: raise InterpreterException(%d, "IN-CHAR at the end of the input")' % (c, ip))
+			self.emit('store(%s, ord(%s))' % (addr, c))
+		return True
+
+arithmetic_operators = {'ADD': '+', 'SUB': '-', 'MUL': '*', 'DIV': '//', 'MOD': '%'}
+
+# Checks if a simulated stack item is a literal number
+def is_constant(expr):
+	return not expr.startswith('t')
+
+# Translates the decoded program into the source of a Python function
+# that builds the list of block functions
+def compile_source(program):
+	entries = set([0, len(program)])
+	for pc in range(len(program)):
+		name, arg, ip = program[pc]
+		if name == 'LABEL':
+			entries.add(arg)
+		elif name == 'CALL':
+			entries.add(pc + 1)
+	entries = sorted(entries)
+
+	lines = ['def make_blocks(code, stack, call_stack, heap, blocks, out_string, in_char, in_num):',
+		'\tpush = stack.append',
+		'\tpop = stack.pop',
+		'\tstore = heap.store',
+		'\tretrieve = heap.retrieve']
+	for i in range(len(entries) - 1):
+		compiler = BlockCompiler(program, entries[i], entries[i + 1])
+		lines += ['\t' + line for line in compiler.compile()]
+		lines.append('\tblocks[%d] = block_%d' % (entries[i], entries[i]))
+	return '\n'.join(lines) + '\n'
+
+# Compiles the decoded program. Returns the list of block functions,
+# indexed by the instruction where each block starts.
+def compile_program(program, code, stack, call_stack, heap, out_string, in_char, in_num):
+	source = compile_source(program)
+	namespace = {}
+	exec(compile(source, '<whitespace>', 'exec'), globals(), namespace)
+	blocks = [None] * (len(program) + 1)
+	namespace['make_blocks'](code, stack, call_stack, heap, blocks, out_string, in_char, in_num)
+	return blocks
+
+# Runs the compiled program until END
+def run_compiled(blocks, program, program_length):
+	pc = 0
+	try:
+		while pc >= 0:
+			if pc == len(program):
+				raise InterpreterException(program_length, "End of program without END")
+			pc = blocks[pc]()
+	except IndexError:
+		raise InterpreterException(program[pc][2], "Stack or heap access out of range")
+	except ZeroDivisionError:
+		raise InterpreterException(program[pc][2], "Division by zero")
+	except OverflowError:
+		raise InterpreterException(program[pc][2], "OUT-CHAR with an invalid character")
+
+# Reads a source map written by WhiteSpace.dump_map. Each line has the
+# ip of an instruction and its description, separated by a tab.
+def read_source_map(path):
+	source_map = {}
+	f = open(path)
+	for line in f:
+		ip, description = line.rstrip('\n').split('\t', 1)
+		source_map[int(ip)] = description
+	f.close()
+	return source_map
 
 ################################################################
+# Cache of decoded programs
+#
+# A cache file holds the whitespace characters of a program, its decoded
+# instructions and its labels, marshalled together with a key made of
+# the hash of the source and the versions of the interpreter and Python.
+
+CACHE_MAGIC = 'whitespace-cache'
+
+# Returns the versions of the interpreter and Python, which must be the
+# same to read the marshalled files
+def format_version():
+	return '%s:%d:%s' % (__version__, marshal.version, sys.version)
+
+# Returns the key identifying the source of a program
+def cache_key(data):
+	key = hashlib.sha256(format_version().encode() + b'\0')
+	key.update(data)
+	return key.hexdigest()
+
+# Returns the path of the cache file of a program
+def cache_path(filename, key, cache_dir=None):
+	if cache_dir is not None:
+		return os.path.join(cache_dir, key + '.wsc')
+	return os.path.splitext(filename)[0] + '.wsc'
 
-# Parse program arguments
-parser = optparse.OptionParser()
-parser.add_option("-v", "--verbose",  action="store_true", default=False, help="Activate verbose mode")
-parser.add_option("-s", "--stack",  action="store_true", default=False, help="Show the stack after each intruction execution")
-parser.add_option("-p", "--pause",  action="store_true", default=False, help="Pause the execution after each instruction")
-
-(opts, args) = parser.parse_args()
-if len(args) != 1:
-	print ("Please specify the filename of the program")
-	parser.print_help()
-	print()
-	print ("Whitespace interpreter by Miguel Colom")
-	print ("http://mcolom.perso.math.cnrs.fr/")
-	sys.exit(-1)
-
-# Read options	
-G_verbose = opts.verbose
-G_stack = opts.stack
-G_pause = opts.pause
-
-call_return = -1
-
-# Memory and stacks
-extra_space = 65536
-stack = []
-call_stack = []
-labels = {}
-
-# Read program
-f = open(args[0])
-text = f.read(-1)
-f.close()
+# Reads the (code, program, labels) of a cache file, or None if the
+# file doesn't exist or doesn't match the key
+def read_cache(path, key):
+	try:
+		f = open(path, 'rb')
+		try:
+			magic, file_key, code, program, labels = marshal.load(f)
+		finally:
+			f.close()
+	except (OSError, EOFError, ValueError, TypeError):
+		return None
+	if magic != CACHE_MAGIC or file_key != key:
+		return None
+	return code, program, labels
+
+# Writes a cache file. Errors are ignored, as the cache is optional.
+def write_cache(path, key, code, program, labels):
+	tmp_path = '%s.%d.tmp' % (path, os.getpid())
+	try:
+		directory = os.path.dirname(path)
+		if directory and not os.path.isdir(directory):
+			os.makedirs(directory)
+		f = open(tmp_path, 'wb')
+		try:
+			marshal.dump((CACHE_MAGIC, key, bytes(code), program, labels), f)
+		finally:
+			f.close()
+		os.replace(tmp_path, path)
+	except OSError:
+		try:
+			os.remove(tmp_path)
+		except OSError:
+			pass
+
+################################################################
+# Snapshots
 #
-print_verbose("Program read, %d characters" % len(text))
+# A snapshot file holds the state of a VM between two instructions: its
+# program (as in a cache file), the index of the next instruction, the
+# steps run, the stacks, the heap and the number of characters read and
+# written. It's marshalled and compressed, and can only be resumed with
+# the same versions of the interpreter and Python.
 
-memory = [0] * (len(text) + extra_space)
+SNAPSHOT_MAGIC = 'whitespace-snapshot'
 
-# Load program into memory
-ip = 0
-for c in text:
-	v = ord(c)
-	if v in (SPACE, TAB, LF):
-		memory[ip] = v
-		ip += 1
-	else:
-		print_verbose("Ignored colored character {0:s} at ip={1}".format(c, ip))
+# Writes a snapshot file. The previous one is replaced at once, so it's
+# kept if the process is stopped while writing.
+def write_snapshot(path, state):
+	tmp_path = '%s.%d.tmp' % (path, os.getpid())
+	f = open(tmp_path, 'wb')
+	try:
+		f.write(zlib.compress(marshal.dumps((SNAPSHOT_MAGIC, format_version()) + state)))
+	finally:
+		f.close()
+	os.replace(tmp_path, path)
+
+# Returns the state saved in a snapshot file
+def read_snapshot(path):
+	f = open(path, 'rb')
+	try:
+		data = f.read()
+	finally:
+		f.close()
+	try:
+		snapshot = marshal.loads(zlib.decompress(data))
+	except (zlib.error, EOFError, ValueError, TypeError):
+		snapshot = None
+	if not isinstance(snapshot, tuple) or snapshot[:2] != (SNAPSHOT_MAGIC, format_version()):
+		raise ValueError("%s is not a snapshot of this version of the interpreter" % path)
+	return snapshot[2:]
+
+################################################################
+# Profiler
 #
-program_length = ip
-print_verbose("Program loaded, %d positions in memory" % program_length)
+# Counts the executions of each instruction while the VM runs. The
+# program is divided into regions, each one going from a LABEL to the
+# next one. The time is sampled: the clock is only read at the first
+# jump or call after every sample_steps instructions, and the time since
+# the previous sample is charged to the current region, and to the
+# subroutines in progress. CALLs also record the instructions run until
+# the matching RETURN (inclusive counts).
+
+# Execution counts of a program, filled by WhitespaceVM.run_profiled
+class Profiler:
+	sample_steps = 1 << 12
+
+	def __init__(self, program, labels, source_map=None):
+		self.program = program
+		self.source_map = source_map or {}
+		self.counts = [0] * len(program)
+		self.steps = 0
+		self.elapsed = 0.0
+		#
+		# The region of each instruction is the index following its
+		# LABEL (0 before the first one), as in the resolved operands
+		self.regions = [0] * (len(program) + 1)
+		region = 0
+		for pc in range(len(program)):
+			if program[pc][0] == 'LABEL':
+				region = pc + 1
+			self.regions[pc] = region
+		self.regions[len(program)] = region
+		self.region_time = {}
+		#
+		self.names = {0: '<start>'}
+		for label in labels:
+			self.names[labels[label]] = label_name(label)
+		#
+		# Subroutines: target -> [calls, instructions, time], and the
+		# frames of the calls in progress
+		self.calls = {}
+		self.frames = []
+		self.active = {}
+		self.last_sample = None
 
-# Look for LABEL instructions
-find_and_execute_labels(labels, memory, instructions, stack, call_stack, program_length)
+	# Records a CALL to target
+	def enter(self, target, steps):
+		self.frames.append((target, steps))
+		self.active[target] = self.active.get(target, 0) + 1
+		self.calls.setdefault(target, [0, 0, 0.0])[0] += 1
 
-# Start program execution
-ip = 0
-print_verbose("Set ip=0 to start execution")
+	# Records a RETURN. Recursive calls are only counted once, in the
+	# outermost one.
+	def leave(self, steps):
+		if not self.frames:
+			return
+		target, call_steps = self.frames.pop()
+		self.active[target] -= 1
+		if self.active[target] == 0:
+			self.calls[target][1] += steps - call_steps
 
-# Run until finished or exception
-finished = False
-while not finished:
-	instruction_ip = ip
+	# Charges the time since the previous sample to the region of pc and
+	# to the subroutines in progress. Returns the steps of the next sample.
+	def sample(self, pc, steps):
+		now = time.perf_counter()
+		if self.last_sample is not None:
+			elapsed = now - self.last_sample
+			self.elapsed += elapsed
+			region = self.regions[pc]
+			self.region_time[region] = self.region_time.get(region, 0.0) + elapsed
+			for target in self.active:
+				if self.active[target]:
+					self.calls[target][2] += elapsed
+		self.last_sample = now
+		return steps + self.sample_steps
 
-	# Identify instruction
-	name = identify_instruction(memory, ip)
-	if name != '':
-		instruction_ip = ip
-		instruction_def = instructions[name]
+	# Returns the name of the region starting at index, with its description
+	def region_name(self, index):
+		name = self.names.get(index)
+		if name is None:
+			name = 'ip=%d' % self.program[index - 1][2]
+		description = self.source_map.get(self.program[index - 1][2]) if index > 0 else None
+		if description:
+			name += ' [%s]' % description
+		return name
 
-		ip += len(instruction_def[0])
+	# Writes the execution counts of the instructions to a JSON file,
+	# {ip: count}. The instructions fused in a superinstruction are
+	# counted as many times as it was run.
+	def save_counts(self, f):
+		counts = {}
+		for pc in range(len(self.counts)):
+			if self.counts[pc] == 0:
+				continue
+			name = self.program[pc][0]
+			length = len(superinstructions[name][0]) if name in superinstructions else 1
+			for k in range(pc, min(pc + length, len(self.program))):
+				ip = self.program[k][2]
+				counts[ip] = counts.get(ip, 0) + self.counts[pc]
+		json.dump(counts, f)
 
-		# Check parameters
-		if instruction_def[1] == PARAM_NUM:
-			num, length = decode_num(memory, ip)
-			label = None
-			print_verbose("%d\t%s %d\t;%s" % ((instruction_ip, name, num, instruction_def[2])))
-		elif instruction_def[1] == PARAM_LABEL:
-			label, length = get_label(memory, ip)
-			num = None
-			label_str = labels[label] if label in labels else "<???>"
-			print_verbose("%d\t%s %s\t;%s" % ((instruction_ip, name, label_str, instruction_def[2])))
-		elif instruction_def[1] == PARAM_NONE:
-			num, label, length = None, None, 0
-			print_verbose("%d\t%s\t;%s" % ((instruction_ip, name, instruction_def[2])))
+	# Writes the hot spot report, limit lines per table
+	def report(self, out=sys.stderr, limit=20):
+		# The percentages are of the instructions dispatched, where a
+		# superinstruction counts once
+		dispatches = sum(self.counts)
+		total = dispatches or 1
+		out.write("Profile: %d instructions (%d dispatched) in %.3fs\n" % (self.steps, dispatches, self.elapsed))
+		#
+		out.write("\nHot instructions:\n%12s %7s %8s  %s\n" % ('count', '%', 'ip', 'instruction'))
+		order = sorted(range(len(self.counts)), key=lambda pc: -self.counts[pc])
+		for pc in order[:limit]:
+			if self.counts[pc] == 0:
+				break
+			name, arg, ip = self.program[pc]
+			text = name
+			if (instructions.get(name) or superinstructions[name])[1] == PARAM_NUM:
+				text += ' %d' % arg
+			if ip in self.source_map:
+				text += '\t[%s]' % self.source_map[ip]
+			out.write("%12d %6.2f%% %8d  %s\n" % (self.counts[pc], 100.0 * self.counts[pc] / total, ip, text))
+		#
+		opcodes = {}
+		regions = {}
+		for pc in range(len(self.counts)):
+			name = self.program[pc][0]
+			opcodes[name] = opcodes.get(name, 0) + self.counts[pc]
+			region = self.regions[pc]
+			regions[region] = regions.get(region, 0) + self.counts[pc]
+		out.write("\nOpcodes:\n%12s %7s  %s\n" % ('count', '%', 'opcode'))
+		for name in sorted(opcodes, key=lambda name: -opcodes[name]):
+			if opcodes[name] == 0:
+				break
+			out.write("%12d %6.2f%% %s\n" % (opcodes[name], 100.0 * opcodes[name] / total, name))
+		#
+		out.write("\nLabels (exclusive):\n%12s %7s %10s  %s\n" % ('count', '%', 'time', 'label'))
+		for region in sorted(regions, key=lambda region: -regions[region])[:limit]:
+			if regions[region] == 0:
+				break
+			out.write("%12d %6.2f%% %9.3fs  %s\n" % (regions[region], 100.0 * regions[region] / total,
+					self.region_time.get(region, 0.0), self.region_name(region)))
+		#
+		if self.calls:
+			out.write("\nSubroutines (inclusive, %% of the instructions):\n%10s %12s %7s %10s  %s\n" % ('calls', 'count', '%', 'time', 'label'))
+			for target in sorted(self.calls, key=lambda target: -self.calls[target][1])[:limit]:
+				calls, count, elapsed = self.calls[target]
+				out.write("%10d %12d %6.2f%% %9.3fs  %s\n" % (calls, count, 100.0 * count / (self.steps or 1), elapsed,
+						self.region_name(target)))
+
+################################################################
+# Virtual machine
+
+# The heap of the VM, separated from the program. The low addresses,
+# which programs fill from 0 up (as the heapidx allocator of the
+# generator does), are kept in a typed array. It only grows when a cell
+# close to its end is stored, up to dense_size cells, and the others go
+# to a dictionary, so the memory used depends on the cells actually
+# touched.
+class Heap:
+	dense_size = 1 << 20
+
+	def __init__(self):
+		self.clear()
+
+	# Empties the heap
+	def clear(self):
+		self.dense = array.array('q')
+		self.sparse = {}
+
+	# Returns the value at the address, 0 if it was never stored
+	def retrieve(self, addr):
+		if addr < 0:
+			raise IndexError("negative heap address %d" % addr)
+		try:
+			return self.dense[addr]
+		except IndexError:
+			return self.sparse.get(addr, 0)
+
+	# Stores a value at the address
+	def store(self, addr, value):
+		dense = self.dense
+		if addr >= len(dense):
+			if addr >= self.dense_size or addr > 2 * len(dense) + 1024:
+				self.sparse[addr] = value
+				return
+			self.grow(addr + 1)
+			dense = self.dense
+		elif addr < 0:
+			raise IndexError("negative heap address %d" % addr)
+		try:
+			dense[addr] = value
+		except (OverflowError, TypeError):
+			# The value doesn't fit in the typed array (a big or
+			# non-integer number), so keep Python objects from now on
+			self.dense = dense = list(dense)
+			dense[addr] = value
+
+	# Grows the dense region to hold at least size cells, moving there
+	# the cells of the dictionary it now covers
+	def grow(self, size):
+		dense = self.dense
+		start = len(dense)
+		size = min(max(size, 2 * start, 1024), self.dense_size)
+		extra = size - start
+		if isinstance(dense, array.array):
+			dense.frombytes(bytes(extra * dense.itemsize))
+		else:
+			dense.extend([0] * extra)
+		if self.sparse:
+			for addr in [addr for addr in self.sparse if start <= addr < size]:
+				self.store(addr, self.sparse.pop(addr))
+
+	__getitem__ = retrieve
+	__setitem__ = store
+
+# Reads the input of the VM in large blocks. Regular files are memory
+# mapped, and other streams are read with as few calls as possible.
+class InputReader:
+	chunk_size = 1 << 16
+
+	def __init__(self, stream):
+		self.stream = stream
+		self.buffer = ''
+		self.index = 0
+		self.offset = 0 # Characters before the buffer
+		self.eof = False
+		self.fed_eof = False
+		self.mapped = None
+		self.read_chunk = self.open(stream)
+
+	# Returns a function that reads the next block of text, '' if it
+	# isn't complete yet and None at the end of the input. Without a
+	# stream, the input is given with feed().
+	def open(self, stream):
+		if stream is None:
+			self.feed_decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder('utf-8')(), True)
+			return self.read_fed
+		try:
+			fd = stream.fileno()
+			regular = stat.S_ISREG(os.fstat(fd).st_mode)
+		except (AttributeError, OSError, ValueError):
+			regular = False
+		raw = getattr(stream, 'buffer', None)
+		#
+		if regular:
+			offset = os.lseek(fd, 0, os.SEEK_CUR)
+			if os.fstat(fd).st_size <= offset:
+				return lambda: None
+			self.mapped = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+			self.mapped.seek(offset)
+			return self.decoder(stream, self.mapped.read)
+		elif hasattr(raw, 'read1'):
+			return self.decoder(stream, raw.read1)
+		else:
+			def read_text():
+				return stream.read(self.chunk_size) or None
+			return read_text
+
+	# Returns a function decoding the blocks of bytes given by read
+	def decoder(self, stream, read):
+		encoding = getattr(stream, 'encoding', None) or 'utf-8'
+		decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(encoding)(), True)
+		def read_bytes():
+			data = read(self.chunk_size)
+			if not data:
+				return decoder.decode(b'', True) or None
+			return decoder.decode(data)
+		return read_bytes
+
+	# Reads the next block into the buffer. Returns False at the end of
+	# the input.
+	def fill(self):
+		while not self.eof:
+			chunk = self.read_chunk()
+			if chunk is None:
+				self.eof = True
+				self.close()
+			elif chunk:
+				self.offset += len(self.buffer)
+				self.buffer = chunk
+				self.index = 0
+				return True
+		return False
+
+	# Adds bytes to the input, when there is no stream
+	def feed(self, data):
+		self.offset += self.index
+		self.buffer = self.buffer[self.index:] + self.feed_decoder.decode(data)
+		self.index = 0
+
+	# Marks the end of the fed input
+	def feed_eof(self):
+		self.feed(b'')
+		self.buffer += self.feed_decoder.decode(b'', True)
+		self.fed_eof = True
+
+	# Returns the next block of fed input: there is nothing but the
+	# buffer, so it's only called at the end
+	def read_fed(self):
+		if not self.fed_eof:
+			raise InterpreterException(0, "Reading input that has not been fed yet")
+		return None
+
+	# Returns the number of characters read
+	def position(self):
+		return self.offset + self.index
+
+	# Reads and forgets count characters
+	def skip(self, count):
+		while count > 0 and (self.index < len(self.buffer) or self.fill()):
+			n = min(count, len(self.buffer) - self.index)
+			self.index += n
+			count -= n
+
+	# Whether read_char won't have to wait for more fed input
+	def char_ready(self):
+		return self.stream is not None or self.fed_eof or self.index < len(self.buffer)
+
+	# Returns the next line if it's complete, or everything at the end of
+	# the fed input. Returns None if read_line would have to wait.
+	def peek_line(self):
+		end = self.buffer.find('\n', self.index)
+		if end >= 0:
+			return self.buffer[self.index:end + 1]
+		if self.fed_eof:
+			return self.buffer[self.index:]
+		return None
+
+	# Releases the memory mapped file
+	def close(self):
+		if self.mapped is not None:
+			self.mapped.close()
+			self.mapped = None
+
+	# Returns the next character, or '' at the end of the input
+	def read_char(self):
+		try:
+			c = self.buffer[self.index]
+		except IndexError:
+			if not self.fill():
+				return ''
+			c = self.buffer[0]
+		self.index += 1
+		return c
+
+	# Returns the next line including the LF, or '' at the end of the input
+	def read_line(self):
+		parts = []
+		while self.index < len(self.buffer) or self.fill():
+			end = self.buffer.find('\n', self.index)
+			if end >= 0:
+				parts.append(self.buffer[self.index:end + 1])
+				self.index = end + 1
+				break
+			parts.append(self.buffer[self.index:])
+			self.index = len(self.buffer)
+		return ''.join(parts)
+
+# Text output written to an asyncio StreamWriter, for WhitespaceVM.run_async
+class StreamOutput:
+	def __init__(self, writer, encoding='utf-8'):
+		self.writer = writer
+		self.encoding = encoding
+
+	def write(self, string):
+		self.writer.write(string.encode(self.encoding, 'surrogatepass'))
+
+	# The writer is drained by run_async
+	def flush(self):
+		pass
+
+# A Whitespace virtual machine. Several of them can be used in the same
+# process, each one with its own program, state and I/O streams.
+# The output is buffered, and written at END, before reading input or
+# when output_limit characters are waiting.
+class WhitespaceVM:
+	output_limit = 1 << 16
+
+	def __init__(self, stdin=None, stdout=None, compile=False, verbose=False, stack=False, pause=False, interactive=True,
+			profile=False):
+		self.stdin = stdin if stdin is not None else sys.stdin
+		self.stdout = stdout if stdout is not None else sys.stdout
+		self.compile = compile
+		self.verbose = verbose
+		self.show_stack = stack
+		self.pause = pause
+		self.interactive = interactive
+		self.profile = profile
+		#
+		self.program = []
+		self.fused_program = []
+		self.fast_program = []
+		self.fusions = 0
+		self.label_problems = []
+		self.underflows = []
+		self.labels = {}
+		self.code = []
+		self.program_length = 0
+		self.blocks = None
+		self.heap = Heap()
+		self.stack = []
+		self.call_stack = []
+		self.pc = 0
+		self.steps = 0
+		self.finished = False
+		self.call_return = -1
+		self.output = []
+		self.output_size = 0
+		self.output_written = 0
+		self.input = None
+		self.source_map = {}
+		self.profiler = None
+		self.step_limit = UNBOUNDED
+
+	# Loads the text of a program (a string, or UTF-8 bytes), ignoring the
+	# characters that are not space, tab or LF, and decodes it. The other
+	# characters are deleted with a single translate(). Every byte of
+	# a multibyte UTF-8 character is above 127, so the bytes can be
+	# filtered without decoding them.
+	def load(self, text):
+		if isinstance(text, str):
+			self.print_verbose("Program read, %d characters" % len(text))
+			data = text.encode('utf-8', 'surrogatepass')
+		else:
+			self.print_verbose("Program read, %d bytes" % len(text))
+			data = bytes(text)
+		code = data.translate(None, NOT_WHITESPACE)
+		self.print_verbose("Program loaded, %d positions in memory" % len(code))
+		#
+		program, labels = decode_program(code, len(code))
+		self.print_verbose("Program decoded, %d instructions, %d labels" % (len(program), len(labels)))
+		self.load_decoded(code, program, labels)
+
+	# Loads a program file. With cache, the decoded program is stored in
+	# a cache file (next to the source, or in cache_dir) and read from
+	# there as long as the source and the interpreter version are the same.
+	# In verbose mode, the source map (by default the .wsmap file next to
+	# the source) is read to describe the instructions. The file is mapped
+	# in memory rather than read.
+	def load_file(self, filename, cache=False, cache_dir=None, source_map=None):
+		f = open(filename, 'rb')
+		try:
+			if os.fstat(f.fileno()).st_size > 0:
+				data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			else:
+				data = b''
+			try:
+				self.load_data(filename, data, cache, cache_dir, source_map)
+			finally:
+				if data:
+					data.close()
+		finally:
+			f.close()
+
+	# Loads the data of a program file, for load_file
+	def load_data(self, filename, data, cache, cache_dir, source_map):
+		if source_map is None:
+			source_map = os.path.splitext(filename)[0] + '.wsmap'
+		if (self.verbose or self.profile) and os.path.exists(source_map):
+			self.source_map = read_source_map(source_map)
+			self.print_verbose("Source map read from %s" % source_map)
+		#
+		if cache:
+			key = cache_key(data)
+			path = cache_path(filename, key, cache_dir)
+			decoded = read_cache(path, key)
+			if decoded is not None:
+				self.print_verbose("Program read from cache %s" % path)
+				self.load_decoded(*decoded)
+				return
+		#
+		self.load(data)
+		if cache:
+			write_cache(path, key, self.code, self.program, self.labels)
+
+	# Sets the program from its whitespace characters and decoded form.
+	# When interpreting, run() and the profiler execute a copy of the
+	# program with superinstructions, while step() executes the original
+	# instructions, so the debugging options show all of them. The stack
+	# depth is verified, and the copy of run() only checks it for the
+	# instructions that may underflow.
+	def load_decoded(self, code, program, labels):
+		self.code = code
+		self.program_length = len(code)
+		self.program = program
+		self.labels = labels
+		self.fused_program = self.fast_program = program
+		self.fusions = 0
+		self.label_problems = check_labels(code, program)
+		for ip, message in self.label_problems:
+			self.print_verbose("%s at ip=%d" % (message, ip))
+		safe, self.underflows = verify_stack(program)
+		self.print_verbose("Stack depth verified for %d of %d instructions" % (safe.count(True), len(program)))
+		for ip, message in self.underflows:
+			self.print_verbose("Stack underflow at ip=%d: %s" % (ip, message))
+		if not self.compile:
+			self.fused_program, self.fusions = fuse_program(program)
+			self.fast_program = mark_checked(self.fused_program, safe)
+			self.print_verbose("%d superinstructions fused" % self.fusions)
+		self.reset()
+		#
+		self.blocks = None
+		if self.compile:
+			self.blocks = compile_program(self.program, self.code, self.stack, self.call_stack, self.heap,
+						self.out_string, self.in_char, self.in_num)
+			self.print_verbose("Program compiled, %d blocks" % (len(self.blocks) - self.blocks.count(None)))
+
+	# Loads the program of another VM. The decoded, fused and checked
+	# programs are shared, as they are never modified.
+	def load_shared(self, vm):
+		self.code = vm.code
+		self.program_length = vm.program_length
+		self.program = vm.program
+		self.labels = vm.labels
+		self.fused_program = vm.fused_program
+		self.fast_program = vm.fast_program
+		self.fusions = vm.fusions
+		self.label_problems = vm.label_problems
+		self.underflows = vm.underflows
+		self.source_map = vm.source_map
+		self.reset()
+		self.blocks = None
+		if self.compile:
+			self.blocks = compile_program(self.program, self.code, self.stack, self.call_stack, self.heap,
+						self.out_string, self.in_char, self.in_num)
+
+	# Puts the machine back in its initial state, keeping the program.
+	# The lists are modified in place because the compiled code uses them.
+	def reset(self):
+		self.heap.clear()
+		if self.input is None or self.input.stream is not self.stdin:
+			if self.input is not None:
+				self.input.close()
+			self.input = InputReader(self.stdin)
+		del self.stack[:]
+		del self.call_stack[:]
+		self.pc = 0
+		self.steps = 0
+		self.finished = False
+		self.call_return = -1
+		self.output_written = 0
+		if self.profile:
+			self.profiler = Profiler(self.fused_program, self.labels, self.source_map)
+
+	# Runs the program until END. The loop is chosen once: the
+	# instructions are only run one by one through step() when a
+	# debugging option is on.
+	def run(self):
+		try:
+			if self.blocks is not None:
+				run_compiled(self.blocks, self.program, self.program_length)
+				self.finished = True
+			elif self.profiler is not None:
+				if not self.finished:
+					self.run_profiled()
+			elif self.verbose or self.pause or self.show_stack:
+				self.print_verbose("Set ip=0 to start execution")
+				while not self.finished:
+					self.step()
+			elif not self.finished:
+				self.run_fast()
+		finally:
+			self.flush_output()
+
+	# Runs the program like run(), but stops at the first jump or call
+	# after count more instructions, between two instructions. Returns
+	# True when the program has finished.
+	def run_steps(self, count):
+		if self.blocks is not None or self.profiler is not None or self.verbose or self.pause or self.show_stack:
+			raise InterpreterException(self.pc, "Programs can't be stopped when compiled, profiled or debugged")
+		self.step_limit = self.steps + count
+		try:
+			self.run()
+		finally:
+			self.step_limit = UNBOUNDED
+		return self.finished
+
+	# Saves the state of the machine to a snapshot file, when it's
+	# stopped between two instructions by run_steps or at the end. The
+	# buffered output is written first.
+	def save_snapshot(self, path):
+		self.flush_output()
+		heap = self.heap
+		dense = heap.dense.tobytes() if isinstance(heap.dense, array.array) else heap.dense
+		write_snapshot(path, (bytes(self.code), self.program, self.labels, self.pc, self.steps, self.finished,
+				self.stack, self.call_stack, dense, heap.sparse, self.input.position(), self.output_written))
+
+	# Loads a program and the state of the machine from a snapshot file,
+	# so that run() goes on from there. The input that was read before
+	# the snapshot is skipped.
+	def load_snapshot(self, path):
+		if self.compile:
+			raise InterpreterException(0, "Compiled programs can't be resumed")
+		(code, program, labels, pc, steps, finished, stack, call_stack, dense, sparse,
+				input_position, output_written) = read_snapshot(path)
+		self.load_decoded(code, program, labels)
+		self.pc = pc
+		self.steps = steps
+		self.finished = finished
+		self.stack[:] = stack
+		self.call_stack[:] = call_stack
+		if isinstance(dense, bytes):
+			self.heap.dense.frombytes(dense)
+		else:
+			self.heap.dense = dense
+		self.heap.sparse = sparse
+		self.input.skip(input_position)
+		self.output_written = output_written
+		self.print_verbose("Snapshot read from %s, %d instructions run" % (path, steps))
+
+	# Runs the program until END as a coroutine, with the input read from
+	# an asyncio StreamReader and the output written to a StreamWriter.
+	# The VM stops before IN-CHAR and IN-NUM until their input arrives,
+	# and lets the other tasks run every slice_steps instructions or so,
+	# so that many sessions can share an event loop. The compiled mode,
+	# the profiler and the debugging options can't be used.
+	async def run_async(self, reader, writer, slice_steps=1 << 16):
+		if self.blocks is not None or self.profiler is not None or self.verbose or self.pause or self.show_stack:
+			raise InterpreterException(0, "Programs can't be run asynchronously when compiled, profiled or debugged")
+		stdout = self.stdout
+		self.stdout = StreamOutput(writer)
+		if self.input is not None:
+			self.input.close()
+		self.input = InputReader(None)
+		try:
+			while True:
+				self.run_steps(slice_steps)
+				await writer.drain()
+				if self.finished:
+					break
+				name, arg, ip = self.fast_program[self.pc]
+				if name == 'CHECK':
+					name, arg = arg
+				if (name == 'IN-CHAR' or name == 'IN-NUM') and self.waiting(name):
+					data = await reader.read(InputReader.chunk_size)
+					if data:
+						self.input.feed(data)
+					else:
+						self.input.feed_eof()
+				else:
+					await asyncio.sleep(0)
+		finally:
+			self.stdout = stdout
+
+	# Whether an input instruction has to wait for more input, which can
+	# only happen when the input is fed by run_async. In interactive
+	# mode, the invalid numbers are skipped here, asking again, so that
+	# IN-NUM waits for a valid one.
+	def waiting(self, name):
+		reader = self.input
+		if reader.stream is not None:
+			return False
+		if name == 'IN-CHAR':
+			return not reader.char_ready()
+		while True:
+			line = reader.peek_line()
+			if line is None:
+				return True
+			if line == '' or not self.interactive:
+				return False
+			try:
+				int(line.replace('\n', ''))
+				return False
+			except ValueError:
+				reader.read_line()
+				self.out_string("[INTERPRETER] Please enter a number\n")
+
+	# Runs the program until END without any of the debugging options.
+	# It does the same as exec_instruction, with the state in local
+	# variables and the instructions ordered by how often generated
+	# programs use them. The stack depth is not checked: the instructions
+	# that may underflow it are in CHECK records, which go through
+	# exec_instruction. For run_async, it also stops before an input
+	# instruction that has to wait, and at the first jump or call after
+	# step_limit instructions.
+	def run_fast(self):
+		program = self.fast_program
+		stack = self.stack
+		call_stack = self.call_stack
+		retrieve = self.heap.retrieve
+		store = self.heap.store
+		push = stack.append
+		pop = stack.pop
+		out_string = self.out_string
+		pc = self.pc
+		steps = self.steps
+		limit = self.step_limit
+		try:
+			while True:
+				name, arg, ip = program[pc]
+				if name == 'PUSH':
+					push(arg)
+					pc += 1
+				elif name == 'SDUPLI':
+					push(stack[-1])
+					pc += 1
+				elif name == 'RETRIEVE':
+					n = pop()
+					if n < 0:
+						raise InterpreterException(ip, "RETRIEVE with negative address")
+					push(retrieve(n))
+					pc += 1
+				elif name == 'STORE':
+					value = pop()
+					addr = pop()
+					if addr < 0:
+						raise InterpreterException(ip, "STORE with negative address")
+					store(addr, value)
+					pc += 1
+				elif name == 'ADD-ADDRESS' and stack and stack[-1] >= 0:
+					addr = stack[-1]
+					store(addr, retrieve(addr) + arg)
+					pc += 6
+					steps += 5
+				elif name == 'LOOP-TEST' and stack and stack[-1] >= 0:
+					if retrieve(stack[-1]) == 0:
+						pc = arg
+						if steps >= limit:
+							steps += 3
+							break
+					else:
+						pc += 3
+					steps += 2
+				elif name == 'HEAPIDX':
+					value = retrieve(0)
+					push(value)
+					store(0, value + arg)
+					pc += 8
+					steps += 7
+				elif name == 'ADD':
+					push(pop() + pop())
+					pc += 1
+				elif name == 'SSWAP':
+					stack[-1], stack[-2] = stack[-2], stack[-1]
+					pc += 1
+				elif name == 'JUMP':
+					if arg is None:
+						raise unknown_label(self.code, ip, name, "jumping")
+					pc = arg
+					if steps >= limit:
+						steps += 1
+						break
+				elif name == 'JUMP-ZERO':
+					if stack[-1] == 0:
+						if arg is None:
+							raise unknown_label(self.code, ip, name, "jumping")
+						pc = arg
+						pop()
+						if steps >= limit:
+							steps += 1
+							break
+					else:
+						pc += 1
+						pop()
+				elif name == 'JUMP-NEG':
+					if stack[-1] < 0:
+						if arg is None:
+							raise unknown_label(self.code, ip, name, "jumping")
+						pc = arg
+						pop()
+						if steps >= limit:
+							steps += 1
+							break
+					else:
+						pc += 1
+						pop()
+				elif name == 'LABEL':
+					pc += 1
+				elif name == 'OUT-CHAR':
+					out_string('%c' % pop())
+					pc += 1
+				elif name == 'SUB':
+					n1 = pop()
+					push(pop() - n1)
+					pc += 1
+				elif name == 'CALL':
+					if arg is None:
+						raise unknown_label(self.code, ip, name, "calling")
+					call_stack.append(pc + 1)
+					pc = arg
+					if steps >= limit:
+						steps += 1
+						break
+				elif name == 'RETURN':
+					if not call_stack:
+						raise InterpreterException(ip, "RETURN with empty call_stack")
+					pc = call_stack.pop()
+				elif name == 'END':
+					pc += 1
+					steps += 1
+					self.finished = True
+					break
+				else:
+					if name == 'CHECK':
+						name, arg = arg
+					if (name == 'IN-CHAR' or name == 'IN-NUM') and self.waiting(name):
+						break
+					pc, self.finished = self.exec_instruction(name, arg, pc, ip)
+					if self.finished:
+						steps += 1
+						break
+				steps += 1
+		except IndexError:
+			if pc == len(program):
+				raise InterpreterException(self.program_length, "End of program without END")
+			raise
+		except OverflowError: # OUT-CHAR, the only one that can raise it
+			raise InterpreterException(ip, "OUT-CHAR with an invalid character")
+		finally:
+			self.pc = pc
+			self.steps = steps
+
+	# Runs the program until END, counting the instructions executed in
+	# the profiler. It's run_fast, counting each dispatch and recording
+	# the calls, and taking a time sample at the first jump or call after
+	# every sample_steps instructions. The debugging options are not used.
+	def run_profiled(self):
+		profiler = self.profiler
+		counts = profiler.counts
+		enter = profiler.enter
+		leave = profiler.leave
+		program = self.fast_program
+		stack = self.stack
+		call_stack = self.call_stack
+		retrieve = self.heap.retrieve
+		store = self.heap.store
+		push = stack.append
+		pop = stack.pop
+		out_string = self.out_string
+		pc = self.pc
+		steps = self.steps
+		sample = profiler.sample(pc, steps)
+		try:
+			while True:
+				name, arg, ip = program[pc]
+				counts[pc] += 1
+				if name == 'PUSH':
+					push(arg)
+					pc += 1
+				elif name == 'SDUPLI':
+					push(stack[-1])
+					pc += 1
+				elif name == 'RETRIEVE':
+					n = pop()
+					if n < 0:
+						raise InterpreterException(ip, "RETRIEVE with negative address")
+					push(retrieve(n))
+					pc += 1
+				elif name == 'STORE':
+					value = pop()
+					addr = pop()
+					if addr < 0:
+						raise InterpreterException(ip, "STORE with negative address")
+					store(addr, value)
+					pc += 1
+				elif name == 'ADD-ADDRESS' and stack and stack[-1] >= 0:
+					addr = stack[-1]
+					store(addr, retrieve(addr) + arg)
+					pc += 6
+					steps += 5
+				elif name == 'LOOP-TEST' and stack and stack[-1] >= 0:
+					if retrieve(stack[-1]) == 0:
+						pc = arg
+						if steps >= sample:
+							sample = profiler.sample(pc, steps)
+					else:
+						pc += 3
+					steps += 2
+				elif name == 'HEAPIDX':
+					value = retrieve(0)
+					push(value)
+					store(0, value + arg)
+					pc += 8
+					steps += 7
+				elif name == 'ADD':
+					push(pop() + pop())
+					pc += 1
+				elif name == 'SSWAP':
+					stack[-1], stack[-2] = stack[-2], stack[-1]
+					pc += 1
+				elif name == 'JUMP':
+					if arg is None:
+						raise unknown_label(self.code, ip, name, "jumping")
+					pc = arg
+					if steps >= sample:
+						sample = profiler.sample(pc, steps)
+				elif name == 'JUMP-ZERO':
+					if stack[-1] == 0:
+						if arg is None:
+							raise unknown_label(self.code, ip, name, "jumping")
+						pc = arg
+						if steps >= sample:
+							sample = profiler.sample(pc, steps)
+					else:
+						pc += 1
+					pop()
+				elif name == 'JUMP-NEG':
+					if stack[-1] < 0:
+						if arg is None:
+							raise unknown_label(self.code, ip, name, "jumping")
+						pc = arg
+						if steps >= sample:
+							sample = profiler.sample(pc, steps)
+					else:
+						pc += 1
+					pop()
+				elif name == 'LABEL':
+					pc += 1
+				elif name == 'OUT-CHAR':
+					out_string('%c' % pop())
+					pc += 1
+				elif name == 'SUB':
+					n1 = pop()
+					push(pop() - n1)
+					pc += 1
+				elif name == 'CALL':
+					if arg is None:
+						raise unknown_label(self.code, ip, name, "calling")
+					call_stack.append(pc + 1)
+					pc = arg
+					enter(arg, steps + 1)
+					if steps >= sample:
+						sample = profiler.sample(pc, steps)
+				elif name == 'RETURN':
+					if not call_stack:
+						raise InterpreterException(ip, "RETURN with empty call_stack")
+					pc = call_stack.pop()
+					leave(steps + 1)
+				elif name == 'END':
+					pc += 1
+					steps += 1
+					self.finished = True
+					break
+				else:
+					if name == 'CHECK':
+						name, arg = arg
+					pc, self.finished = self.exec_instruction(name, arg, pc, ip)
+					if self.finished:
+						steps += 1
+						break
+				steps += 1
+		except IndexError:
+			if pc == len(program):
+				raise InterpreterException(self.program_length, "End of program without END")
+			raise
+		except OverflowError: # OUT-CHAR, the only one that can raise it
+			raise InterpreterException(ip, "OUT-CHAR with an invalid character")
+		finally:
+			self.pc = pc
+			self.steps = steps
+			profiler.sample(pc, steps)
+			profiler.steps = steps
+
+	# Executes the next instruction. Returns True when the program has
+	# finished.
+	def step(self):
+		if self.blocks is not None:
+			raise InterpreterException(0, "Compiled programs can't be run step by step")
+		pc = self.pc
+		if pc == len(self.program):
+			raise InterpreterException(self.program_length, "End of program without END")
+		name, arg, ip = self.program[pc]
+
+		if self.verbose:
+			self.trace(name, arg, ip)
 
 		# Interactive mode
-		if G_pause:
+		if self.pause:
 			is_call = (name == "CALL")
 			if is_call:
-				print ("[INTERPRETER] CALL instruction: press S to step-out")
-			if call_return == -1 or call_return == ip:
-				c = sys.stdin.read(1)				
+				self.out_string("[INTERPRETER] CALL instruction: press S to step-out\n")
+			if self.call_return == -1 or self.call_return == pc:
+				self.flush_output()
+				c = self.input.read_char()
 				if is_call and (c == "s" or c == "S"): # step-out
-					call_return = ip + length
-					print(("call return: " + str(call_return)))
+					self.call_return = pc + 1
+					self.out_string("call return: " + str(self.program[self.call_return][2]) + "\n")
 
 		# Execute instruction
-		new_ip, finished = exec_instruction(name, num, label, length, ip, memory, stack, call_stack, labels)
+		self.pc, self.finished = self.exec_instruction(name, arg, pc, ip)
+		self.steps += 1
 
 		# Print stack status before instruction execution
-		if G_stack:
-			print('Stack: %s' % stack)
-			print('Call stack: %s' % call_stack)
-
-		# Increment IP by the length of the parameter,
-		# or set its new value if it's a jump.
-		if new_ip >= 0:
-			ip = new_ip
-		else:
-			ip += length
-			
-		if ip == call_return:
-			print("[INTERPRETER] End of subroutine")
-			call_return = -1			
+		if self.show_stack:
+			self.out_string('Stack: %s\n' % self.stack)
+			self.out_string('Call stack: %s\n' % self.call_stack)
+
+		if self.pc == self.call_return:
+			self.out_string("[INTERPRETER] End of subroutine\n")
+			self.call_return = -1
+		if self.finished:
+			self.flush_output()
+		return self.finished
+
+	# Prints the instruction about to be executed
+	def trace(self, name, arg, ip):
+		instruction_def = instructions[name]
+		description = instruction_def[2]
+		if ip in self.source_map:
+			description += " [%s]" % self.source_map[ip]
+		if instruction_def[1] == PARAM_NUM:
+			self.print_verbose("%d\t%s %d\t;%s" % ((ip, name, arg, description)))
+		elif instruction_def[1] == PARAM_LABEL:
+			if arg is None:
+				label_str = "<???>"
+			elif arg < len(self.program):
+				label_str = self.program[arg][2]
+			else:
+				label_str = self.program_length
+			self.print_verbose("%d\t%s %s\t;%s" % ((ip, name, label_str, description)))
+		elif instruction_def[1] == PARAM_NONE:
+			self.print_verbose("%d\t%s\t;%s" % ((ip, name, description)))
+
+	# Reads a character from stdin
+	def in_char(self):
+		if self.output:
+			self.flush_output()
+		return self.input.read_char()
+
+	# Reads a number from stdin. In interactive mode it asks again until
+	# the number is valid. Returns None at the end of the input, or for
+	# an invalid number when not interactive.
+	def in_num(self):
+		while True:
+			self.flush_output()
+			string = self.input.read_line()
+			if string == '':
+				return None
+			try:
+				return int(string.replace('\n', ''))
+			except ValueError:
+				if not self.interactive:
+					return None
+				self.out_string("[INTERPRETER] Please enter a number\n")
+
+	# Outputs a string to stdout
+	def out_string(self, string):
+		self.output.append(string)
+		self.output_size += len(string)
+		if self.output_size >= self.output_limit:
+			self.flush_output()
+
+	# Writes the buffered output to stdout
+	def flush_output(self):
+		if self.output:
+			self.stdout.write(''.join(self.output))
+			self.output_written += self.output_size
+			self.output = []
+			self.output_size = 0
+		self.stdout.flush()
+
+	# Prints a debug message
+	def print_verbose(self, string):
+		if self.verbose:
+			self.out_string("[INFO] " + string + "\n")
+
+	# Executes a single decoded instruction. Returns the index of the next
+	# instruction to execute and whether the program has finished.
+	def exec_instruction(self, name, arg, pc, ip):
+		stack = self.stack
+		call_stack = self.call_stack
+		heap = self.heap
+		new_pc = pc + 1
+		finished = False
+
+		# *** Stack Manipulation ***
+		if name == 'PUSH':
+			stack.append(arg)
+		elif name == 'SDUPLI':
+			if len(stack) < 1:
+				raise InterpreterException(ip, "SDUPLI with empty stack")
+			stack.append(stack[-1])
+		elif name == 'SCOPY':
+			pos = len(stack)-arg-1
+			if pos < 0:
+			  raise InterpreterException(ip, "SCOPY with negative argument")
+			stack.append(stack[pos])
+		elif name == 'SSWAP':
+			if len(stack) < 2:
+				raise InterpreterException(ip, "SSWAP with less than two elements")
+			n1 = stack.pop()
+			n2 = stack.pop()
+			stack.append(n1)
+			stack.append(n2)
+		elif name == 'SDISCARD':
+			if len(stack) > 0:
+				stack.pop()
+		elif name == 'SSLIDE':
+			if len(stack) > 0:
+				top = stack.pop()
+				for i in range(arg):
+					stack.pop()
+				stack.append(top) # Recover top
+		#
+		# *** Arithmetic ***
+		elif name == 'ADD':
+			if len(stack) < 2:
+				raise InterpreterException(ip, "ADD with less than two elements")
+			stack.append(stack.pop() + stack.pop())
+		elif name == 'SUB':
+			if len(stack) < 2:
+				raise InterpreterException(ip, "SUB with less than two elements")
+			n1 = stack.pop()
+			n2 = stack.pop()
+			stack.append(n2 - n1)
+		elif name == 'MUL':
+			if len(stack) < 2:
+				raise InterpreterException(ip, "MUL with less than two elements")
+			stack.append(stack.pop() * stack.pop())
+		elif name == 'DIV':
+			if len(stack) < 2:
+				raise InterpreterException(ip, "DIV with less than two elements")
+			n1 = stack.pop()
+			n2 = stack.pop()
+			if n1 == 0:
+				raise InterpreterException(ip, "DIV by zero")
+			stack.append(n2 // n1)
+		elif name == 'MOD':
+			if len(stack) < 2:
+				raise InterpreterException(ip, "MOD with less than two elements")
+			n1 = stack.pop()
+			n2 = stack.pop()
+			if n1 == 0:
+				raise InterpreterException(ip, "MOD by zero")
+			stack.append(n2 % n1)
+		# *** Heap Access ***
+		elif name == 'STORE':
+			if len(stack) < 2:
+				raise InterpreterException(ip, "STORE with less than two elements")
+			value = stack.pop()
+			addr = stack.pop()
+			if addr < 0:
+				raise InterpreterException(ip, "STORE with negative address")
+			heap.store(addr, value)
+		elif name == 'RETRIEVE':
+			if len(stack) < 1:
+				raise InterpreterException(ip, "RETREIVE with empty stack")
+			n = stack.pop()
+			if n < 0:
+				raise InterpreterException(ip, "RETRIEVE with negative address")
+			stack.append(heap.retrieve(n))
+		# *** Flow Control ***
+		elif name == 'LABEL':
+			pass # Already resolved when decoding
+		elif name == 'CALL':
+			if arg is None:
+				raise unknown_label(self.code, ip, name, "calling")
+			call_stack.append(new_pc)
+			new_pc = arg
+		elif name == 'JUMP':
+			if arg is None:
+				raise unknown_label(self.code, ip, name, "jumping")
+			new_pc = arg
+		elif name == 'JUMP-ZERO':
+			if len(stack) < 1:
+				raise InterpreterException(ip, "JUMP-ZERO with empty stack")
+			test = stack.pop()
+			if test == 0:
+				if arg is None:
+					raise unknown_label(self.code, ip, name, "jumping")
+				new_pc = arg
+		elif name == 'JUMP-NEG':
+			if len(stack) < 1:
+				raise InterpreterException(ip, "JUMP-NEG with empty stack")
+			test = stack.pop()
+			if test < 0:
+				if arg is None:
+					raise unknown_label(self.code, ip, name, "jumping")
+				new_pc = arg
+		elif name == 'RETURN':
+			if len(call_stack) < 1:
+				raise InterpreterException(ip, "RETURN with empty call_stack")
+			new_pc = call_stack.pop()
+		elif name == 'END':
+			finished = True
+		# *** I/O ***
+		elif name == 'OUT-NUM':
+			if len(stack) < 1:
+				raise InterpreterException(ip, "OUT-NUM with empty stack")
+			string = '%s' % stack.pop()
+			self.out_string(string)
+		elif name == 'OUT-CHAR':
+			if len(stack) < 1:
+				raise InterpreterException(ip, "OUT-CHAR with empty stack")
+			c = stack.pop()
+			if not 0 <= c < 0x110000:
+				raise InterpreterException(ip, "OUT-CHAR with an invalid character")
+			self.out_string('%c' % c)
+		elif name == 'IN-NUM':
+			if len(stack) < 1:
+				raise InterpreterException(ip, "IN-NUM with empty stack")
+			number = self.in_num()
+			if number is None:
+				raise InterpreterException(ip, "IN-NUM without a valid number")
+			addr = stack.pop()
+			if addr < 0:
+				raise InterpreterException(ip, "IN-NUM with negative address")
+			heap.store(addr, number)
+		elif name == 'IN-CHAR':
+			if len(stack) < 1:
+				raise InterpreterException(ip, "IN-CHAR with empty stack")
+			c = self.in_char()
+			if not c:
+				raise InterpreterException(ip, "IN-CHAR at the end of the input")
+			addr = stack.pop()
+			if addr < 0:
+				raise InterpreterException(ip, "IN-CHAR with negative address")
+			heap.store(addr, ord(c))
+		#
+		# *** Superinstructions ***
+		# When one would fail, only the first instruction of its pattern
+		# is executed, and the ones that follow raise the error.
+		elif name in superinstructions:
+			if name == 'HEAPIDX':
+				value = heap.retrieve(0)
+				stack.append(value)
+				heap.store(0, value + arg)
+				new_pc = pc + 8
+			elif len(stack) < 1 or stack[-1] < 0:
+				first_name, first_arg = superinstructions[name][0][0]
+				return self.exec_instruction(first_name, first_arg, pc, ip)
+			elif name == 'ADD-ADDRESS':
+				addr = stack[-1]
+				heap.store(addr, heap.retrieve(addr) + arg)
+				new_pc = pc + 6
+			elif name == 'LOOP-TEST':
+				if heap.retrieve(stack[-1]) == 0:
+					new_pc = arg
+				else:
+					new_pc = pc + 3
+		#
+		return new_pc, finished
+
+################################################################
+# Sessions served on a TCP port
+
+# Serves the program loaded in vm: each connection is a session running
+# it in a VM of its own, with the connection as its input and output.
+# All the sessions share the event loop. The errors of the program are
+# sent to the client. Any other error ends the session and is reported
+# on stderr, without stopping the server.
+async def serve(vm, host, port):
+	async def session(reader, writer):
+		session_vm = WhitespaceVM(interactive=vm.interactive)
+		session_vm.load_shared(vm)
+		try:
+			await session_vm.run_async(reader, writer)
+		except InterpreterException as e:
+			writer.write(("\n%s\n" % e).encode('utf-8'))
+		except ConnectionError:
+			pass
+		except Exception as e:
+			sys.stderr.write("Session ended by an internal error: %s: %s\n" % (type(e).__name__, e))
+			writer.write(b"\nInternal error\n")
+		finally:
+			writer.close()
+	server = await asyncio.start_server(session, host, port)
+	async with server:
+		await server.serve_forever()
+
+################################################################
+
+def main():
+	# Parse program arguments
+	parser = optparse.OptionParser()
+	parser.add_option("-v", "--verbose",  action="store_true", default=False, help="Activate verbose mode")
+	parser.add_option("-s", "--stack",  action="store_true", default=False, help="Show the stack after each intruction execution")
+	parser.add_option("-p", "--pause",  action="store_true", default=False, help="Pause the execution after each instruction")
+	parser.add_option("-c", "--compile",  action="store_true", default=False, help="Compile the program to Python before running it (no debugging)")
+	parser.add_option("-b", "--batch",  action="store_true", default=False, help="Stop on invalid numbers instead of asking again")
+	parser.add_option("--cache",  action="store_true", default=False, help="Keep the decoded program in a .wsc file next to the source")
+	parser.add_option("--cache-dir",  default=None, help="Keep the decoded programs in this directory")
+	parser.add_option("--profile",  action="store_true", default=False, help="Count the instructions executed and print a hot spot report at the end (no debugging)")
+	parser.add_option("--profile-output",  default=None, help="Save the execution count of each instruction (by ip) to this JSON file, for WhiteSpace.assign_labels")
+	parser.add_option("--serve",  default=None, help="Run the program for each connection to this [HOST:]PORT, all in one process (no debugging)")
+	parser.add_option("--snapshot",  default=None, help="Save the state of the VM to this file every --snapshot-every instructions (no debugging)")
+	parser.add_option("--snapshot-every",  type="int", default=1 << 26, help="Instructions between snapshots (default: %default)")
+	parser.add_option("--resume",  default=None, help="Resume the program from a snapshot file, instead of starting a program file")
+	parser.add_option("-m", "--map",  default=None, help="Source map describing the instructions in verbose mode (default: the .wsmap file next to the program)")
+
+	(opts, args) = parser.parse_args()
+	if opts.resume is not None and args:
+		parser.error("--resume takes the program from the snapshot, not from a file")
+	if opts.resume is None and len(args) != 1:
+		print ("Please specify the filename of the program")
+		parser.print_help()
+		print()
+		print ("Whitespace interpreter by Miguel Colom")
+		print ("http://mcolom.perso.math.cnrs.fr/")
+		sys.exit(-1)
+	if (opts.profile or opts.profile_output is not None) and opts.compile:
+		parser.error("--profile can't be used with --compile")
+	if opts.serve is not None and (opts.compile or opts.profile or opts.profile_output or opts.verbose
+			or opts.stack or opts.pause):
+		parser.error("--serve can't be used with --compile, --profile or the debugging options")
+	if opts.snapshot is not None and (opts.compile or opts.profile or opts.profile_output or opts.verbose
+			or opts.stack or opts.pause or opts.serve):
+		parser.error("--snapshot can't be used with --compile, --profile, --serve or the debugging options")
+	if opts.resume is not None and opts.compile:
+		parser.error("--resume can't be used with --compile")
+
+	vm = WhitespaceVM(compile=opts.compile, verbose=opts.verbose, stack=opts.stack, pause=opts.pause,
+			interactive=not opts.batch, profile=opts.profile or opts.profile_output is not None)
+	if opts.resume is not None:
+		vm.load_snapshot(opts.resume)
 	else:
-		ip += 1
+		vm.load_file(args[0], cache=opts.cache or opts.cache_dir is not None, cache_dir=opts.cache_dir,
+				source_map=opts.map)
+	for ip, message in vm.label_problems:
+		sys.stderr.write("Warning: %s at ip=%d\n" % (message, ip))
+	for ip, message in vm.underflows:
+		sys.stderr.write("Warning: stack underflow at ip=%d: %s\n" % (ip, message))
+	if opts.serve is not None:
+		host, separator, port = opts.serve.rpartition(':')
+		try:
+			asyncio.run(serve(vm, host or '127.0.0.1', int(port)))
+		except KeyboardInterrupt:
+			pass
+		return
+	try:
+		if opts.snapshot is not None:
+			while not vm.run_steps(opts.snapshot_every):
+				vm.save_snapshot(opts.snapshot)
+		else:
+			vm.run()
+	finally:
+		if opts.profile:
+			vm.profiler.report(sys.stderr)
+		if opts.profile_output is not None:
+			f = open(opts.profile_output, 'w')
+			vm.profiler.save_counts(f)
+			f.close()
+
+if __name__ == '__main__':
+	main()
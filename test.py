@@ -1,6 +1,6 @@
 '''This file is to test the whitespace and translator objects'''
-import os
 import whitespac3 as w
+import interpreter
 #char to int use ord('c')
 #int to char use 
 output = open("output.ws", 'w')
@@ -21,10 +21,17 @@ s.endloop(label)
 # s.stringin()
 s.exit()
 
-output.write(s.string)
+s.dump(output)
 
 output.close()
 
-os.system("python interpreter.py output.ws")
+# descriptions of the instructions, used by the interpreter's verbose mode
+source_map = open("output.wsmap", 'w')
+s.dump_map(source_map)
+source_map.close()
 
-# os.system("python interpreter.py --verbose output.ws")
+vm = interpreter.WhitespaceVM()
+vm.load(s.string)
+vm.run()
+
+# vm = interpreter.WhitespaceVM(verbose=True)
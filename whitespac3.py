@@ -1,10 +1,125 @@
 class WhiteSpace(object):
     '''This class can be used to generate whitespace code'''
-    def __init__(self, explain=True):
-        self.string = ""
+    # name: (IMP, explanation, command, takes a number or label)
+    commands = {
+        'push': ('stack_manip', 'push', ' ', True),
+        'dupl': ('stack_manip', 'dupliate_top', '\n ', False),
+        'swap': ('stack_manip', 'swap_top_two', '\n\t', False),
+        'delete': ('stack_manip', 'discard_top', '\n\n', False),
+        'add': ('arith', 'add', '  ', False),
+        'sub': ('arith', 'sub', ' \t', False),
+        'mult': ('arith', 'mult', ' \n', False),
+        'div': ('arith', 'div', '\t ', False),
+        'mod': ('arith', 'mod', '\t\t', False),
+        'store': ('heap', 'store', ' ', False),
+        'retrieve': ('heap', 'retrieve', '\t', False),
+        'label': ('flow', 'add_label', '  ', True),
+        'subr': ('flow', 'call_subroutine', ' \t', True),
+        'jump': ('flow', 'jump_to_', ' \n', True),
+        'jumpzer': ('flow', 'jump_to_if_top_zer', '\t ', True),
+        'jumpneg': ('flow', 'jump_to_if_top_neg', '\t\t', True),
+        'endsub': ('flow', 'break_subroutine', '\t\n', False),
+        'exit': ('flow', 'exit_pgrm', '\n\n', False),
+        'printnum': ('iocom', 'oututput_top_num', ' \t', False),
+        'printchar': ('iocom', 'output_top_char', '  ', False),
+        'charin': ('iocom', 'read_in_char', '\t ', False),
+        'numin': ('iocom', 'read_in_num', '\t\t', False),
+    }
+    # IMP: (explanation, code)
+    imps = {
+        'stack_manip': ('IMP:stack_manip', ' '),
+        'arith': ('IMP:arithmetic', '\t '),
+        'heap': ('heap_access', '\t\t'),
+        'flow': ('IMP:Flow_Control', '\n'),
+        'iocom': ('IMP:I/O', '\t\n'),
+    }
+    flush_limit = 1 << 16
+    string_base = 128
+    string_chunk = 32
+    # the helpers that can be called instead of inlined
+    helpers = ('stringin', 'compare', 'add_address')
+    # the commands that take a label
+    label_commands = ('label', 'subr', 'jump', 'jumpzer', 'jumpneg')
+    def __init__(self, explain=True, sink=None, inline=False, map_sink=None, string_data=False, call=(),
+                 static=False):
+        '''
+        If explain, each command is described in the source map
+            (see source_map), or in the code itself if inline.
+
+        If a sink (file-like object) is given, the code is
+            written to it every flush_limit instructions,
+            and when flush() is called at the end.
+            The source map is written to map_sink if given.
+
+        If string_data, printstr keeps the strings packed
+            in numbers (see packed_string).
+
+        The helpers named in call (or all of them if call
+            is True) are emitted as subroutines, once for
+            each set of arguments, and called (see helper).
+            The others are inlined.
+
+        If static, store(None, val) and new_num get heap
+            addresses from the generator (see allocate)
+            rather than from heapidx at run time.
+        '''
+        self.instructions = []
         self.explain = explain
+        self.inline = inline
+        self.sink = sink
+        self.map_sink = map_sink
+        self.string_data = string_data
+        self.call = self.helpers if call is True else tuple(call)
+        self.written = 0
+        self.encoded = {}
+        self.routines = {}
+        self.static = static
+        self.variables = {}
+        self.optimized = False
+        self.short_labels = False
         self.labelidx = 1
-        self.store(0,1)# initialize heapidx
+        self.heap_start = 1
+        self.store(0, self.heap_start)# initialize heapidx
+    @property
+    def string(self):
+        '''the whitespace code of the program'''
+        return ''.join(self.chunks())
+    def chunks(self, size=4096):
+        '''the whitespace code, size instructions at a time'''
+        encode = self.encode
+        code = self.instructions
+        for i in range(0, len(code), size):
+            yield ''.join([encode(*c) for c in code[i:i + size]])
+    def dump(self, f):
+        '''write the whitespace code to a file-like object'''
+        for chunk in self.chunks():
+            f.write(chunk)
+    def flush(self):
+        '''
+        write the instructions to the sink and forget them
+        optimize() only sees the instructions not flushed yet.
+        '''
+        self.dump(self.sink)
+        if self.map_sink is not None:
+            self.dump_map(self.map_sink)
+        self.written += sum([self.size(*i) for i in self.instructions])
+        del self.instructions[:]
+    def source_map(self):
+        '''
+        (offset, description) of the commands, where offset is
+            the position of the command in the whitespace code
+            once the other characters are ignored
+            (the ip of the interpreter)
+        '''
+        offset = self.written
+        for name, arg in self.instructions:
+            if self.explain and name != 'write':
+                yield offset, self.describe(name, arg)
+            offset += self.size(name, arg)
+    def dump_map(self, f):
+        '''write the source map to a file-like object, one command per line'''
+        for offset, description in self.source_map():
+            f.write('{0}\t{1}\n'.format(offset, description))
     def __str__(self):
         '''how to print the whitespace code'''
         return self.string
@@ -25,7 +140,7 @@ class WhiteSpace(object):
         There is only one global namespace so all labels must be unique.
         '''
         numstr = ''
-        if self.explain:
+        if self.explain and self.inline:
             numstr += 'num_{0}'.format(num)
         if num > 0:
             numstr += ' '
@@ -33,40 +148,82 @@ class WhiteSpace(object):
             numstr += '\t'
         numstr += str(bin(num))[2:].replace('0', ' ').replace('1', '\t').replace('b', '') + '\n'
         return numstr
+    def label_code(self, label):
+        '''
+        add a label assigned by assign_labels to the code
+        Label n is the n-th string of spaces and tabs,
+            shortest first: '', ' ', '\t', '  ', ' \t'...
+        '''
+        labelstr = ''
+        if self.explain and self.inline:
+            labelstr += 'label_{0}'.format(label)
+        labelstr += bin(label + 1)[3:].replace('0', ' ').replace('1', '\t') + '\n'
+        return labelstr
     def write(self, string):
         '''add new item to the whitespace program'''
-        self.string += string
+        self.emit('write', string)
+    def emit(self, name, arg=None):
+        '''add a command to the program, see commands'''
+        self.instructions.append((name, arg))
+        if self.sink is not None and len(self.instructions) >= self.flush_limit:
+            self.flush()
+    def explained(self, explanation, code):
+        '''code preceded by its explanation if explained inline'''
+        if self.explain and self.inline:
+            return explanation + code
+        return code
+    def describe(self, name, arg=None):
+        '''explanation of a command'''
+        imp, explanation, code, param = self.commands[name]
+        description = self.imps[imp][0] + ' ' + explanation
+        if param:
+            description += ' num_{0}'.format(arg)
+        return description
+    def size(self, name, arg=None):
+        '''number of whitespace characters of a command'''
+        if name == 'write':
+            return len([c for c in arg if c in ' \t\n'])
+        imp, explanation, code, param = self.commands[name]
+        size = len(self.imps[imp][1]) + len(code)
+        if param and self.short_labels and name in self.label_commands:
+            size += len(bin(arg + 1)) - 2 # digits and LF
+        elif param:
+            size += len(bin(abs(arg))) # sign, digits and LF
+        return size
+    def encode(self, name, arg=None):
+        '''whitespace code of a command'''
+        if name == 'write':
+            return arg
+        key = (name, arg, self.explain and self.inline)
+        try:
+            return self.encoded[key]
+        except KeyError:
+            pass
+        imp, explanation, code, param = self.commands[name]
+        string = getattr(self, imp)() + self.explained(explanation, code)
+        if param and self.short_labels and name in self.label_commands:
+            string += self.label_code(arg)
+        elif param:
+            string += self.number(arg)
+        self.encoded[key] = string
+        return string
 
 #Stack manipulation commands:
     def stack_manip(self):
         '''Instruction modification parameter (IMP) stack manipulation'''
-        if self.explain:
-            self.write("IMP:stack_manip")
-        self.write(" ")
+        return self.explained(*self.imps['stack_manip'])
     def push(self, num):
         '''push a num to the stack'''
-        self.stack_manip()
-        if self.explain:
-            self.write("push")
-        self.write(" " + self.number(num))
+        self.emit('push', num)
     def dupl(self):
         '''duplicate the top item on the stack'''
-        self.stack_manip()
-        if self.explain:
-            self.write("dupliate_top")
-        self.write("\n ")
+        self.emit('dupl')
     def swap(self):
         '''swap the top two items in the stack'''
-        self.stack_manip()
-        if self.explain:
-            self.write("swap_top_two")
-        self.write("\n\t")
+        self.emit('swap')
     def delete(self):
         '''discard the top item int the swap'''
-        self.stack_manip()
-        if self.explain:
-            self.write("discard_top")
-        self.write("\n\n")
+        self.emit('delete')
 
 #Arithmetic commands:
     def arith(self):
@@ -76,9 +233,7 @@ class WhiteSpace(object):
         and replace them with the result of the operation.
         The first item pushed is considered to be left of the operator.
         '''
-        if self.explain:
-            self.write("IMP:arithmetic")
-        self.write("\t ")
+        return self.explained(*self.imps['arith'])
     def add(self, num=None):
         '''
         Add top of stack.
@@ -88,43 +243,28 @@ class WhiteSpace(object):
         '''
         if num is not None:
             self.push(num)
-        self.arith()
-        if self.explain:
-            self.write("add")
-        self.write("  ")
+        self.emit('add')
     def sub(self):
         '''
         subtract top of stack
         The first item pushed is considered to be left of the operator.
         '''
-        self.arith()
-        if self.explain:
-            self.write("sub")
-        self.write(" \t")
+        self.emit('sub')
     def mult(self):
         '''mult top of stack'''
-        self.arith()
-        if self.explain:
-            self.write("mult")
-        self.write(" \n")
+        self.emit('mult')
     def div(self):
         '''
         intiger division on top of stack
         The first item pushed is considered to be left of the operator.
         '''
-        self.arith()
-        if self.explain:
-            self.write("div")
-        self.write("\t ")
+        self.emit('div')
     def mod(self):
         '''
         modulo on top of stack
         The first item pushed is considered to be left of the operator.
         '''
-        self.arith()
-        if self.explain:
-            self.write("mod")
-        self.write("\t\t")
+        self.emit('mod')
 
 # Heap access commands:
     def heapidx(self, n=1, leave=True):
@@ -154,9 +294,7 @@ class WhiteSpace(object):
         which will place the value stored in the location
         at the top of the stack.
         '''
-        if self.explain:
-            self.write("heap_access")
-        self.write("\t\t")
+        return self.explained(*self.imps['heap'])
     def store(self, addr=None, val=None):
         '''
         Push an address then a val and run this command to store it,
@@ -164,13 +302,18 @@ class WhiteSpace(object):
         Returns address if used.
 
         Note: if you use the arguments (None, Val),
-            val will be stored at the current heapidx
+            val will be stored at the current heapidx,
+            or at an address from allocate if static
         '''
         if addr is not None and val is not None:
             self.push(addr)
             self.push(val)
         elif addr is None and val is not None: # get new address
-            self.heapidx(1)
+            if self.static:
+                addr = self.allocate()
+                self.push(addr)
+            else:
+                self.heapidx(1)
             self.dupl()
             self.push(val)
         elif addr is not None and val is None:
@@ -180,12 +323,34 @@ class WhiteSpace(object):
         #     self.retrieve(0)
         #     self.swap()
         #     self.heapidx(1)
-        self.heap()
-        if self.explain:
-            self.write("store")
-        self.write(" ")
+        self.emit('store')
         if addr is not None:
             return addr
+    def allocate(self, size=1):
+        '''
+        Address of size heap cells given by the generator,
+            so that no code is needed to get them.
+        heapidx starts after them at run time, so they
+            must be allocated before the beginning of the
+            program is flushed or optimized.
+        '''
+        if self.written or self.optimized:
+            raise ValueError('heap cells must be allocated before the program is flushed or optimized')
+        addr = self.heap_start
+        self.heap_start += size
+        self.instructions[1] = ('push', self.heap_start)
+        return addr
+    def var(self, name):
+        '''static heap address of a named variable'''
+        if name not in self.variables:
+            self.variables[name] = self.allocate()
+        return self.variables[name]
+    def getvar(self, name):
+        '''push the value of a named variable'''
+        self.retrieve(self.var(name))
+    def setvar(self, name, val=None):
+        '''store val, or the top of the stack, in a named variable'''
+        self.store(self.var(name), val)
     def retrieve(self, addr=None):
         '''
         push an address then run this command,
@@ -193,10 +358,7 @@ class WhiteSpace(object):
         '''
         if addr != None:
             self.push(addr)
-        self.heap()
-        if self.explain:
-            self.write("retrieve")
-        self.write("\t")
+        self.emit('retrieve')
 
 
 # Flow Control
@@ -210,57 +372,32 @@ class WhiteSpace(object):
         Programs must be ended by means of [LF][LF][LF]
             so that the interpreter can exit cleanly.
         '''
-        if self.explain:
-            self.write("IMP:Flow_Control")
-        self.write("\n")
+        return self.explained(*self.imps['flow'])
     def label(self, label=None):
         '''Mark a location in the program, returns the value'''
-        self.flow()
-        if self.explain:
-            self.write("add_label")
         if label is None:
             label = self.labelidx
-            self.write("  " + self.number(label))
             self.labelidx += 1
-        else:
-            self.write("  " + self.number(label))
+        self.emit('label', label)
         return label
     def subr(self, label):
         '''Call a subroutine in the program'''
-        self.flow()
-        if self.explain:
-            self.write("call_subroutine")
-        self.write(" \t" + self.number(label))
+        self.emit('subr', label)
     def jump(self, label):
         '''jump to a label unconditionally'''
-        self.flow()
-        if self.explain:
-            self.write("jump_to_")
-        self.write(" \n" + self.number(label))
+        self.emit('jump', label)
     def jumpzer(self, label):
         '''jump to a label if the top of the stack is 0'''
-        self.flow()
-        if self.explain:
-            self.write("jump_to_if_top_zer")
-        self.write("\t " + self.number(label))
+        self.emit('jumpzer', label)
     def jumpneg(self, label):
         '''jump to a label if the top of the stack is negative'''
-        self.flow()
-        if self.explain:
-            self.write("jump_to_if_top_neg")
-        self.write("\t\t" + self.number(label))
+        self.emit('jumpneg', label)
     def endsub(self):
         '''end subroutine and return control to the caller'''
-        self.flow()
-        if self.explain:
-            self.write("break_subroutine")
-        self.write("\t\n")
+        self.emit('endsub')
     def exit(self):
         '''jump to a label if the top of the stack is negative'''
-        self.flow()
-        if self.explain:
-            self.write("exit_pgrm")
-        self.write("\n\n")
+        self.emit('exit')
 
 # Serial com commands
     def iocom(self):
@@ -272,94 +409,139 @@ class WhiteSpace(object):
         The read instructions take the heap address in which to store
             the result from the top of the stack.
         '''
-        if self.explain:
-            self.write("IMP:I/O")
-        self.write("\t\n")
+        return self.explained(*self.imps['iocom'])
     def printnum(self):
         '''output and delete number at top of stack'''
-        self.iocom()
-        if self.explain:
-            self.write("oututput_top_num")
-        self.write(" \t")
+        self.emit('printnum')
     def printchar(self, char=None):
         '''output and delete character at top of stack'''
         if char is not None:
             self.push(ord(char))
-        self.iocom()
-        if self.explain:
-            self.write("output_top_char")
-        self.write("  ")
+        self.emit('printchar')
     def printstr(self, string=None):
         '''
         Pass in a string to print it in the program
+        With string_data, strings of at least two ASCII
+            characters are printed by a subroutine shared
+            by all the printstr of the same string.
 
         If string not passed in, prints string from
-            memory address at top of stack.
-        '''
-        if string is not None:
-            for i in enumerate(string):
-                self.printchar(i[1])
-        else: pass#print string from memory
-            # self.new_num(1)
-            # loop_label = self.label()
-            # self.swap()
-            # self.dupl()
-            # self.add()
-
-            # # Incriment
-            # self.dupl()
-            # self.dupl()
-            # self.retrieve()
-            # self.add(1)
-            # self.store()
-            # self.jump(loop_label)
-            # self.endloop(loop_label)
+            memory address at top of stack (eats it).
+            The length of the string is in the address
+            and the characters follow, as stringin does.
+        '''
+        if string is None:
+            self.subr(self.routine('print_heap', self.print_heap))
+        elif self.string_data and len(string) > 1 and all(0 < ord(c) < self.string_base for c in string):
+            self.subr(self.packed_string(string))
+        else:
+            for c in string:
+                self.printchar(c)
+    def print_heap(self):
+        '''body of the subroutine printing a string from memory'''
+        done = self.labelidx
+        self.labelidx += 1
+        self.dupl()
+        self.retrieve() # length of the string
+        loop = self.label()
+        self.dupl()
+        self.jumpzer(done)
+        self.swap()
+        self.add(1) # address of the next character
+        self.dupl()
+        self.retrieve()
+        self.printchar()
+        self.swap()
+        self.push(1)
+        self.sub()
+        self.jump(loop)
+        self.label(done)
+        self.delete()
+        self.delete()
+        self.endsub()
+    def packed_string(self, string):
+        '''
+        Label of the subroutine printing a string.
+        It pushes a 0, then the characters string_chunk at a
+            time, packed in numbers in base string_base (the
+            first character in the lowest digit), and jumps
+            to the loop printing them (see print_packed).
+        '''
+        printer = self.routine('print_packed', self.print_packed)
+        def body():
+            self.push(0)
+            for i in reversed(range(0, len(string), self.string_chunk)):
+                number = 0
+                for c in reversed(string[i:i + self.string_chunk]):
+                    number = number * self.string_base + ord(c)
+                self.push(number)
+            self.jump(printer)
+        return self.routine(('string', string), body)
+    def print_packed(self):
+        '''body of the subroutine printing packed strings, until a 0'''
+        self.labelidx += 3
+        done, loop, chunk_done = self.labelidx - 3, self.labelidx - 2, self.labelidx - 1
+        start = self.routines['print_packed']
+        self.dupl()
+        self.jumpzer(done)
+        self.label(loop)
+        self.dupl()
+        self.jumpzer(chunk_done)
+        self.dupl()
+        self.push(self.string_base)
+        self.mod()
+        self.printchar()
+        self.push(self.string_base)
+        self.div()
+        self.jump(loop)
+        self.label(chunk_done)
+        self.delete()
+        self.jump(start)
+        self.label(done)
+        self.delete()
+        self.endsub()
     def charin(self):
         '''read in a character, leave it at top of stack'''
-        self.iocom()
-        if self.explain:
-            self.write("read_in_char")
-        self.write("\t ")
+        self.emit('charin')
     def stringin(self, endchar='\n'):
         '''
         Read in a string, leave addr in stack
 
         String[0]=len(String)-1
         '''
-        self.heapidx(1)
-        self.dupl() #duplicate string start address
-        self.push(0)
-        self.store()
+        def body():
+            self.heapidx(1)
+            self.dupl() #duplicate string start address
+            self.push(0)
+            self.store()
 
-        label = self.label()
+            label = self.label()
 
-        self.heapidx(1)# get new memory address for character
-        self.dupl()
-        self.charin()# save the character in the memory address
-        self.retrieve()# get the new character
+            self.heapidx(1)# get new memory address for character
+            self.dupl()
+            self.charin()# save the character in the memory address
+            self.retrieve()# get the new character
 
-        #if (char != '\n'')
-        self.add(-1*ord(endchar))#subtract endchar
-        end = self.ifstate()
+            #if (char != '\n'')
+            self.add(-1*ord(endchar))#subtract endchar
+            end = self.ifstate()
 
-        #incriment string length
-        self.dupl()#duplicate string start address
-        self.dupl()
-        self.retrieve() #retrieve length of string (first member of the string)
-        self.add(1) #incriment
-        self.store()
+            #incriment string length
+            self.dupl()#duplicate string start address
+            self.dupl()
+            self.retrieve() #retrieve length of string (first member of the string)
+            self.add(1) #incriment
+            self.store()
 
-        #repeat
-        self.jump(label)
-        self.endif(end)
-        self.heapidx(-1, False)# 'deallocate' the endchar
+            #repeat
+            self.jump(label)
+            self.endif(end)
+            self.heapidx(-1, False)# 'deallocate' the endchar
+        self.helper('stringin', (endchar,), body)
 
     def numin(self):
         '''read in a number'''
-        self.iocom()
-        if self.explain:
-            self.write("read_in_num")
-        self.write("\t\t")
+        self.emit('numin')
 
 #Loops
     def loop(self):
@@ -382,6 +564,31 @@ class WhiteSpace(object):
         self.jump(start_label)
         self.label(start_label+1)
 
+    def repeat(self, count=None):
+        '''
+        Starts a loop run count times.
+
+        Push the count then run this, or pass it in.
+
+        The counter is kept on the stack instead of the heap:
+            the body finds the number of times left at the
+            top, and must leave the stack as it found it.
+        '''
+        if count is not None:
+            self.push(count)
+        start_label = self.label()
+        self.labelidx += 1
+        self.dupl()
+        self.jumpzer(start_label+1)
+        return start_label
+
+    def endrepeat(self, start_label):
+        '''Ends a repeat loop, discarding its counter'''
+        self.add(-1)
+        self.jump(start_label)
+        self.label(start_label+1)
+        self.delete()
+
 # Logic
     def ifstate(self):
         """
@@ -420,54 +627,393 @@ class WhiteSpace(object):
 
         compare(">=") # var1 >= Var2?
         """
-        self.labelidx += 3
-        if comparison == '=' or comparison == '==':
-            self.sub()
-            self.jumpzer(self.labelidx-3)
-            self.jump(self.labelidx-2)
-        elif comparison == '<':
-            self.sub()
-            self.jumpneg(self.labelidx-3)
-            self.jump(self.labelidx-2)
-        elif comparison == '<=':
-            self.sub()
-            self.dupl()
-            self.jumpneg(self.labelidx-3)
-            self.jumpzer(self.labelidx-3)
-            self.jump(self.labelidx-2)
-        elif comparison == '>':
-            self.swap()
-            self.sub()
-            self.jumpneg(self.labelidx-3)
-            self.jump(self.labelidx-2)
-        elif comparison == '>=':
-            self.swap()
-            self.sub()
-            self.dupl()
-            self.jumpneg(self.labelidx-3)
-            self.jumpzer(self.labelidx-3)
-            self.jump(self.labelidx-2)
-
-        self.label(self.labelidx-3)
-        self.push(1)
-        self.jump(self.labelidx-1)
-
-        self.label(self.labelidx-2)
-        self.push(0)
-
-        self.label(self.labelidx-1)
+        def body():
+            self.labelidx += 3
+            if comparison == '=' or comparison == '==':
+                self.sub()
+                self.jumpzer(self.labelidx-3)
+                self.jump(self.labelidx-2)
+            elif comparison == '<':
+                self.sub()
+                self.jumpneg(self.labelidx-3)
+                self.jump(self.labelidx-2)
+            elif comparison == '<=':
+                self.sub()
+                self.dupl()
+                self.jumpneg(self.labelidx-3)
+                self.jumpzer(self.labelidx-3)
+                self.jump(self.labelidx-2)
+            elif comparison == '>':
+                self.swap()
+                self.sub()
+                self.jumpneg(self.labelidx-3)
+                self.jump(self.labelidx-2)
+            elif comparison == '>=':
+                self.swap()
+                self.sub()
+                self.dupl()
+                self.jumpneg(self.labelidx-3)
+                self.jumpzer(self.labelidx-3)
+                self.jump(self.labelidx-2)
+
+            self.label(self.labelidx-3)
+            self.push(1)
+            self.jump(self.labelidx-1)
+
+            self.label(self.labelidx-2)
+            self.push(0)
+
+            self.label(self.labelidx-1)
+        self.helper('compare', (comparison,), body)
 
 # Special
+    def routine(self, name, body):
+        '''
+        Label of a subroutine shared by the program.
+        The first time, body() emits the code of the
+            subroutine, which is jumped over.
+        '''
+        if name not in self.routines:
+            label = self.labelidx
+            self.labelidx += 2
+            self.routines[name] = label
+            self.jump(label + 1)
+            self.label(label)
+            body()
+            self.label(label + 1)
+        return self.routines[name]
+    def helper(self, name, args, body):
+        '''
+        Emit a helper, where body() emits its code.
+        If the helper is in call mode, it's a call to a
+            subroutine shared by the uses with the same args.
+            That makes the program smaller, and slower.
+        '''
+        if name in self.call:
+            def subroutine():
+                body()
+                self.endsub()
+            self.subr(self.routine((name,) + args, subroutine))
+        else:
+            body()
     def add_address(self, n):
         '''incriments/decriments value in address at top of stack'''
-        self.dupl()
-        self.dupl()
-        self.retrieve()
-        self.add(n)
-        self.store()
+        def body():
+            self.dupl()
+            self.dupl()
+            self.retrieve()
+            self.add(n)
+            self.store()
+        self.helper('add_address', (n,), body)
     def new_num(self, initializer=0):
-        '''adds a number to the heap. leaves the address in the stack.'''
-        self.heapidx(1)
-        self.dupl()
-        self.push(initializer)
-        self.store()
+        '''
+        adds a number to the heap. leaves the address in the stack.
+        Returns the address if static.
+        '''
+        return self.store(None, initializer)
+
+# Optimization
+    folds = {
+        'add': lambda a, b: a + b,
+        'sub': lambda a, b: a - b,
+        'mult': lambda a, b: a * b,
+        'mod': lambda a, b: a % b,
+    }
+    pure = ('push', 'dupl', 'swap', 'delete', 'add', 'sub', 'mult', 'div', 'mod',
+            'printnum', 'printchar')
+    def assign_labels(self, counts=None):
+        '''
+        Final pass giving the shortest labels to the
+            most used ones. Labels become any string of
+            spaces and tabs instead of numbers (see label_code).
+        A label is used by the jumps and calls to it, or
+            with counts, by the times they were run:
+            a dict {ip: count} of this same program, as
+            saved by interpreter.py --profile-output.
+        Run it after optimize(), before anything is flushed.
+
+        Returns the size of the code (before, after)
+        '''
+        if self.written or self.short_labels:
+            raise ValueError('labels must be assigned once, before the program is flushed')
+        if counts:
+            counts = dict((int(ip), count) for ip, count in counts.items())
+        code = self.instructions
+        uses = {}
+        offset = 0
+        for name, arg in code:
+            if name in self.label_commands:
+                use = uses.setdefault(arg, [0, 0])
+                if name != 'label':
+                    use[0] += counts.get(offset, 0) if counts else 0
+                    use[1] += 1
+            offset += self.size(name, arg)
+        before = offset
+        order = sorted(uses, key=lambda label: (-uses[label][0], -uses[label][1], label))
+        labels = dict((label, n) for n, label in enumerate(order))
+        for i in range(len(code)):
+            name, arg = code[i]
+            if name in self.label_commands:
+                code[i] = (name, labels[arg])
+        for name in self.routines:
+            self.routines[name] = labels[self.routines[name]]
+        self.labelidx = len(labels)
+        self.short_labels = True
+        self.encoded = {}
+        return before, sum([self.size(*i) for i in code])
+    def optimize(self):
+        '''
+        Peephole optimization of the program.
+        Folds arithmetic on constants, removes values that
+            are pushed and then discarded, and removes heap
+            loads and stores that are not needed.
+        The heap loads whose value is known (see propagate),
+            like those of heapidx between labels, become pushes.
+
+        Returns the number of instructions (before, after)
+        '''
+        code = self.instructions
+        before = len(code)
+        self.optimized = True
+        while True:
+            propagated = self.propagate(code)
+            i = 0
+            while i < len(code):
+                rewrite = self.peephole(code, i)
+                if rewrite is None:
+                    i += 1
+                else:
+                    length, replacement = rewrite
+                    code[i:i + length] = replacement
+                    i = max(i - 4, 0) # earlier rules may match now
+            if not propagated:
+                break
+        return before, len(code)
+    def propagate(self, code):
+        '''
+        Follows the constants on the stack and in the heap
+            through straight code, replaces the loads
+            of a known value by a push of it, and drops
+            the stores to a known address that are stored
+            again before any load.
+        Nothing is known after a label or a call, nor about
+            the heap after a store to an unknown address.
+            At the start of the program the heap is all 0.
+
+        Returns the number of loads and stores replaced
+        '''
+        unknown = object()
+        stack = []
+        heap = {}
+        fresh = not self.written # the heap is still all 0
+        unread = {} # address: index of its last store, not loaded since
+        dead = []
+        def pop():
+            return stack.pop() if stack else unknown
+        replaced = 0
+        i = 0
+        while i < len(code):
+            name, arg = code[i]
+            if name == 'push':
+                stack.append(arg)
+            elif name == 'dupl':
+                top = pop()
+                stack += [top, top]
+            elif name == 'swap':
+                top, below = pop(), pop()
+                stack += [top, below]
+            elif name in ('delete', 'printnum', 'printchar'):
+                pop()
+            elif name in ('jumpzer', 'jumpneg'):
+                pop()
+                unread.clear() # the code jumped to may load them
+            elif name in ('add', 'sub', 'mult', 'div', 'mod'):
+                b, a = pop(), pop()
+                if a is unknown or b is unknown or name not in self.folds or (name == 'mod' and b == 0):
+                    stack.append(unknown)
+                else:
+                    stack.append(self.folds[name](a, b))
+            elif name in ('store', 'charin', 'numin'):
+                value = pop() if name == 'store' else unknown
+                addr = pop()
+                if addr is unknown:
+                    heap.clear()
+                    fresh = False
+                else:
+                    heap[addr] = value
+                    if addr in unread:
+                        dead.append(unread[addr])
+                    if name == 'store':
+                        unread[addr] = i
+            elif name == 'retrieve':
+                addr = pop()
+                value = unknown
+                if addr is unknown:
+                    unread.clear()
+                else:
+                    value = heap.get(addr, 0 if fresh else unknown)
+                    unread.pop(addr, None)
+                if value is not unknown:
+                    code[i:i + 1] = [('delete', None), ('push', value)]
+                    replaced += 1
+                    i += 1
+                stack.append(value)
+            elif name != 'write' or self.size(name, arg):
+                # label, subr, jump, endsub, exit, or code
+                # that is not understood: nothing is known
+                stack = []
+                heap = {}
+                fresh = False
+                unread.clear()
+            i += 1
+        for i in sorted(dead, reverse=True):
+            code[i:i + 1] = [('delete', None), ('delete', None)]
+        return replaced + len(dead)
+    def prune(self):
+        '''
+        Control flow pass over the program, run when it's
+            complete (before assign_labels).
+        Collapses chains of jumps, removes the jumps to
+            the next command, the code that can't be
+            reached and the labels that are not used.
+        Shared subroutines that are removed will be emitted
+            again if used later.
+        Code given to write() is not understood, so
+            nothing is done if there is any.
+
+        Returns the number of instructions (before, after)
+        '''
+        code = self.instructions
+        before = len(code)
+        if any(name == 'write' and self.size(name, arg) for name, arg in code):
+            return before, before
+        while True:
+            code = self.thread_jumps(code)
+            reachable = self.reachable(code)
+            used = set(arg for i, (name, arg) in enumerate(code)
+                       if reachable[i] and name in self.label_commands and name != 'label')
+            pruned = [(name, arg) for i, (name, arg) in enumerate(code) if reachable[i]
+                      and (name != 'label' or arg in used or self.written)]
+            if len(pruned) == len(code):
+                break
+            code = pruned
+        self.instructions[:] = code
+        labels = set(arg for name, arg in code if name == 'label')
+        self.routines = dict((name, label) for name, label in self.routines.items()
+                             if label in labels or self.written)
+        return before, len(code)
+    def thread_jumps(self, code):
+        '''
+        The commands with the jumps and calls to a jump
+            going to its destination, and the jumps to
+            the next command removed.
+        '''
+        positions = {}
+        for i, (name, arg) in enumerate(code):
+            if name == 'label':
+                positions.setdefault(arg, i)
+        def destination(label):
+            seen = set()
+            while label in positions and label not in seen:
+                seen.add(label)
+                i = positions[label]
+                while i < len(code) and code[i][0] == 'label':
+                    i += 1
+                if i == len(code) or code[i][0] != 'jump':
+                    break
+                label = code[i][1]
+            return label
+        def next_labels(i):
+            labels = set()
+            i += 1
+            while i < len(code) and code[i][0] == 'label':
+                labels.add(code[i][1])
+                i += 1
+            return labels
+        threaded = []
+        for i, (name, arg) in enumerate(code):
+            if name in self.label_commands and name != 'label':
+                arg = destination(arg)
+                if name == 'jump' and arg in next_labels(i):
+                    continue
+                if name in ('jumpzer', 'jumpneg') and arg in next_labels(i):
+                    name, arg = 'delete', None
+            threaded.append((name, arg))
+        return threaded
+    def reachable(self, code):
+        '''
+        For each command, whether the program can get there
+            from the start. Subroutines return after their call.
+        If code was flushed, its jumps can go to any label.
+        '''
+        positions = {}
+        for i, (name, arg) in enumerate(code):
+            if name == 'label':
+                positions.setdefault(arg, i)
+        reachable = [False] * len(code)
+        pending = [0] if code else []
+        if self.written:
+            pending.extend(positions.values())
+        while pending:
+            i = pending.pop()
+            if i >= len(code) or reachable[i]:
+                continue
+            reachable[i] = True
+            name, arg = code[i]
+            if name in ('jump', 'jumpzer', 'jumpneg', 'subr') and arg in positions:
+                pending.append(positions[arg])
+            if name not in ('jump', 'exit', 'endsub'):
+                pending.append(i + 1)
+        return reachable
+    def peephole(self, code, i):
+        '''
+        Returns (length, replacement) to rewrite the
+            instructions starting at i, or None.
+        '''
+        window = code[i:i + 5] + [(None, None)] * (i + 5 - len(code))
+        (n0, a0), (n1, a1), (n2, a2), (n3, a3), (n4, a4) = window
+        if n0 == 'push':
+            if n1 == 'push' and n2 in self.folds and (n2 != 'mod' or a1 != 0):
+                return 3, [('push', self.folds[n2](a0, a1))]
+            if n1 == 'push' and n2 == 'swap':
+                return 3, [('push', a1), ('push', a0)]
+            if n1 == 'push' and n2 == 'store':
+                if n3 == 'push' and a3 == a0 and n4 == 'retrieve':
+                    return 5, [code[i], code[i + 1], code[i + 2], ('push', a1)]
+                if self.overwritten(code, i + 3, a0):
+                    return 3, []
+            if n1 == 'swap' and n2 == 'store' and n3 == 'push' and a3 == a0 and n4 == 'retrieve':
+                return 5, [('dupl', None), ('push', a0), ('swap', None), ('store', None)]
+            if n1 == 'retrieve' and n2 == 'push' and a2 == a0 and n3 == 'retrieve':
+                return 4, [code[i], code[i + 1], ('dupl', None)]
+            if n1 == 'add' and a0 == 0:
+                return 2, []
+            if n1 == 'add' and n2 == 'push' and n3 == 'add':
+                return 4, [('push', a0 + a2), ('add', None)]
+            if n1 == 'dupl':
+                return 2, [('push', a0), ('push', a0)]
+            if n1 == 'delete':
+                return 2, []
+        elif n0 == 'dupl':
+            if n1 == 'delete':
+                return 2, []
+            if n1 == 'push' and n2 == 'swap' and n3 == 'store' and self.overwritten(code, i + 4, a1):
+                return 4, []
+        elif n0 == 'swap' and n1 == 'swap':
+            return 2, []
+        return None
+    def overwritten(self, code, i, addr):
+        '''
+        True if the value in heap[addr] is stored again
+            from instruction i on, before anything can read it.
+        '''
+        while i < len(code):
+            name, arg = code[i]
+            if name == 'push' and arg == addr and i + 2 < len(code):
+                following = code[i + 1][0], code[i + 2][0]
+                if following in (('swap', 'store'), ('push', 'store')):
+                    return True
+            if name not in self.pure:
+                return False
+            i += 1
+        return False